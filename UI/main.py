@@ -4,6 +4,8 @@ from utility.s3 import S3
 from agent.miracle import MRKL
 from streamlit_extras.colored_header import colored_header
 from utility.authy import Login
+from agent.retrieval import DocumentRouter
+from agent.answer_cache import invalidate_cached_answers
 
 
 
@@ -17,7 +19,7 @@ class Main:
 
             if st.session_state.new_collection_state and st.session_state.new_collection_state != "None":
                 st.session_state.client_db = ClientDB(username=st.session_state.username, collection_name=st.session_state.selected_collection_state)
-                st.session_state.agent = MRKL()
+                st.session_state.agent = MRKL.load()
 
         display_collections = ["None"] + existing_collections
 
@@ -41,6 +43,43 @@ class Main:
         return selected_collection_name, selected_collection_object
     
     
+    @staticmethod
+    def handle_federated_selection(existing_collections):
+
+        def on_change_federated_collections():
+            st.session_state.federated_collections = st.session_state.new_federated_collections
+            st.session_state.federated_vector_stores = st.session_state.client_db.load_vector_stores(st.session_state.federated_collections)
+            st.session_state.agent = MRKL.load()
+
+        def on_change_federated_quota():
+            st.session_state.federated_quota = st.session_state.federated_quota_key
+            st.session_state.agent = MRKL.load()
+
+        default_collections = [name for name in st.session_state.get('federated_collections', []) if name in existing_collections]
+
+        selected_collection_names = st.multiselect(
+            'Search across collections:',
+            existing_collections,
+            default=default_collections,
+            key='new_federated_collections',
+            on_change=on_change_federated_collections,
+            help="Query several collections at once. Results are merged by score."
+        )
+
+        if len(selected_collection_names) == 1:
+            st.info("Select at least two collections to search across them.")
+
+        st.slider(
+            "Results per Collection",
+            min_value=1,
+            max_value=5,
+            value=st.session_state.get('federated_quota', 3),
+            key="federated_quota_key",
+            on_change=on_change_federated_quota,
+        )
+
+        return selected_collection_names
+    
     @staticmethod
     def create_new_collection():
         new_collection_name = st.text_input("Enter new collection name:")
@@ -66,6 +105,8 @@ class Main:
             if delete_collection_selection:
                 try:
                     st.session_state.client_db.client.delete_collection(delete_collection_selection)
+                    DocumentRouter.delete_index(st.session_state.client_db.client, delete_collection_selection)
+                    invalidate_cached_answers(delete_collection_selection)
                     st.session_state.delete_collection_message = f"Collection {delete_collection_selection} deleted successfully!"
                     st.experimental_rerun()
                 except Exception as e:
@@ -88,6 +129,8 @@ class Main:
                 try:
                     collection = st.session_state.client_db.client.get_collection(rename_collection_selection)
                     collection.modify(name=new_name)
+                    DocumentRouter.rename_index(st.session_state.client_db.client, rename_collection_selection, new_name)
+                    invalidate_cached_answers(rename_collection_selection)
                     st.session_state.rename_collection_message = f"Collection {rename_collection_selection} renamed to {new_name} successfully!"
                     st.experimental_rerun()
                 except Exception as e:
@@ -208,6 +251,8 @@ class MainConfig:
             for delete_collection_selection in delete_collection_selections:
                 try:
                     client_db_for_selected_user.client.delete_collection(delete_collection_selection)
+                    DocumentRouter.delete_index(client_db_for_selected_user.client, delete_collection_selection)
+                    invalidate_cached_answers(delete_collection_selection)
                     st.session_state.delete_collection_message = f"Collection/collections deleted successfully!"
                 except Exception as e:
                     st.error(f"Error deleting collection: {e}")
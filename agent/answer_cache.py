@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import sqlite3
+import numpy as np
+import streamlit as st
+from typing import List, Optional, Tuple
+from langchain.docstore.document import Document
+from utility.sqlite import ThreadLocalConnection
+from .retrieval import cosine_similarities
+
+
+ANSWER_CACHE_PATH = os.path.join("inmemorystore", "answer_cache.sqlite")
+
+
+class SemanticAnswerCache:
+    """
+    Cache of final agent answers, looked up by query embedding similarity.
+
+    Every entry belongs to a scope (a hash of the user, the searched collections, the selected
+    document and the agent configuration) and is only matched within it. Entries also record the
+    collections they were answered from, so ingesting into or deleting from a collection drops them.
+    """
+
+    def __init__(self, path: str = ANSWER_CACHE_PATH, ttl_seconds: int = 7 * 24 * 3600, max_entries_per_scope: int = 500):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_scope = max_entries_per_scope
+        self.hits = 0
+        self.misses = 0
+        self._connections = ThreadLocalConnection(path, [
+            "CREATE TABLE IF NOT EXISTS answers "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, scope TEXT NOT NULL, collections TEXT NOT NULL, query TEXT NOT NULL, "
+            "embedding TEXT NOT NULL, answer TEXT NOT NULL, sources TEXT NOT NULL, created_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS answers_scope ON answers (scope)",
+        ])
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    @staticmethod
+    def collections_key(collection_names: List[str]) -> str:
+        # Delimited on both sides, so LIKE '%|name|%' only matches whole names
+        return "|" + "|".join(sorted(collection_names)) + "|"
+
+    @staticmethod
+    def serialize_sources(sources: List[Document]) -> str:
+        return json.dumps([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in sources], default=str)
+
+    @staticmethod
+    def deserialize_sources(value: str) -> List[Document]:
+        return [Document(page_content=source["page_content"], metadata=source["metadata"]) for source in json.loads(value)]
+
+    def lookup(self, query_embedding: List[float], scope: str, threshold: float) -> Optional[Tuple[str, List[Document], float, str]]:
+        """Return the answer, sources, similarity and original query of the closest cached question, if close enough."""
+        rows = self._connection().execute(
+            "SELECT query, embedding, answer, sources FROM answers WHERE scope = ? AND created_at >= ?",
+            (scope, time.time() - self.ttl_seconds),
+        ).fetchall()
+        if not rows:
+            self.misses += 1
+            return None
+
+        similarities = cosine_similarities([json.loads(row[1]) for row in rows], query_embedding)
+        best_index = int(np.argmax(similarities))
+        if similarities[best_index] < threshold:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        query, _, answer, sources = rows[best_index]
+        return answer, self.deserialize_sources(sources), float(similarities[best_index]), query
+
+    def store(self, query: str, query_embedding: List[float], scope: str, collection_names: List[str], answer: str, sources: List[Document]):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT INTO answers (scope, collections, query, embedding, answer, sources, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (scope, self.collections_key(collection_names), query, json.dumps(query_embedding), answer, self.serialize_sources(sources), time.time()),
+            )
+            connection.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            connection.execute(
+                "DELETE FROM answers WHERE scope = ? AND id NOT IN (SELECT id FROM answers WHERE scope = ? ORDER BY created_at DESC LIMIT ?)",
+                (scope, scope, self.max_entries_per_scope),
+            )
+
+    def invalidate_collection(self, collection_name: str) -> int:
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute("DELETE FROM answers WHERE collections LIKE ?", (f"%|{collection_name}|%",))
+        if cursor.rowcount:
+            print(f"Dropped {cursor.rowcount} cached answers for collection {collection_name}")
+        return cursor.rowcount
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM answers")
+        self.hits = 0
+        self.misses = 0
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+
+@st.cache_resource
+def get_answer_cache() -> SemanticAnswerCache:
+    return SemanticAnswerCache()
+
+
+def invalidate_cached_answers(collection_name: str):
+    """Call after anything is ingested into or deleted from a collection."""
+    get_answer_cache().invalidate_collection(collection_name)
@@ -0,0 +1,385 @@
+"""
+Offline build of the BR18 index.
+
+    python -m agent.br18_build --folder BR18_DB --concurrency 8
+
+Summaries are cached per parent split (keyed by content hash) and every upserted batch is
+checkpointed in a manifest, so a failed build picks up where it stopped when run again.
+
+Running it again after the markdown changed is an incremental sync: sections are compared with
+the manifest and only added or changed sections are summarized and upserted, removed ones deleted.
+An index built before the manifest existed is rebuilt from scratch on the first run.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import tiktoken
+import pinecone
+from pathlib import Path
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain.document_loaders import TextLoader
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
+from langchain.prompts import ChatPromptTemplate
+from langchain.schema.output_parser import StrOutputParser
+from langchain.chat_models import ChatOpenAI
+from utility.docstore import SQLiteDocStore
+from .retrieval import ClauseIndex
+
+
+BR18_INDEX_NAME = "br18"
+BR18_ID_KEY = "doc_id"
+BR18_TEXT_KEY = "text"  # Metadata key LangChain's Pinecone store reads the page content from
+BR18_PARENT_STORE_PATH = os.path.join("inmemorystore", "br18_parent_store.sqlite")
+BR18_SUMMARY_CACHE_PATH = os.path.join("savesummary", "br18_summary_cache.jsonl")
+BR18_LEGACY_SUMMARIES_PATH = os.path.join("savesummary", "br18_summaries.json")
+BR18_MANIFEST_PATH = os.path.join("savesummary", "br18_manifest.json")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class BR18IndexBuilder:
+    def __init__(self, folder_path: str, concurrency: int = 4, batch_size: int = 100, upsert_workers: int = 4):
+        self.folder_path = folder_path
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.upsert_workers = upsert_workers
+        self.embeddings = OpenAIEmbeddings()
+        self.parent_store = SQLiteDocStore(BR18_PARENT_STORE_PATH)
+        self.summary_cache = self.load_summary_cache()
+        self.manifest = self.load_manifest()
+        self._lock = threading.Lock()
+
+    def load_documents(self):
+        md_paths = list(Path(self.folder_path).rglob("*.md"))
+        documents = []
+        for path in md_paths:
+            loader = TextLoader(str(path))
+            data = loader.load()
+            documents.extend(data)  # Assuming data is a list of Document objects
+        return documents
+
+    def split_and_chunk_text(self, markdown_document: Document):
+
+        markdown_text = markdown_document.page_content
+
+        # Define headers to split on
+        headers_to_split_on = [
+            ("#", "Header 1"),
+            ("##", "Header 2"),
+            ("###", "Header 3"),
+            ("####", "Header 4"),
+        ]
+
+        markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
+
+        md_header_splits = markdown_splitter.split_text(markdown_text)
+
+        parent_chunk_size = 5000
+        parent_chunk_overlap = 0
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=parent_chunk_size, chunk_overlap=parent_chunk_overlap
+        )
+
+        # Split the header-split documents into chunks
+        all_parent_splits = text_splitter.split_documents(md_header_splits)
+
+        token_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        header_counts = {}
+
+        for split in all_parent_splits:
+            # Stable section key: source, header path and position under that header.
+            # The key survives an edit of the text, which is how the sync tells changed from added.
+            header_path = " > ".join(split.metadata.get(header, '') for _, header in headers_to_split_on)
+            position = header_counts.get(header_path, 0)
+            header_counts[header_path] = position + 1
+            split.metadata['section'] = f"{markdown_document.metadata.get('source', '')}#{header_path}#{position}"
+
+            header_3 = split.metadata.get('Header 3', '')
+            header_4 = split.metadata.get('Header 4', '')
+
+            # Prepend "Section:" to Header 4 if it exists
+            if header_4:
+                header_4 = f"Section: {header_4}"
+
+            metadata_str = f"{header_3}\n\n{header_4}"
+            split.page_content = f"{metadata_str}\n\n{split.page_content}"
+            split.metadata['type'] = 'parents'
+            split.metadata['source'] = markdown_document.metadata.get('source', '')
+            split.metadata['token_count'] = len(token_encoding.encode(split.page_content))
+            split.metadata['char_count'] = len(split.page_content)
+
+            # Deterministic id, so a rerun maps every split to the same parent and vector
+            split.metadata[BR18_ID_KEY] = content_hash(f"{split.metadata['source']}\n{split.page_content}")
+
+        return all_parent_splits
+
+    def load_parent_splits(self) -> List[Document]:
+        parent_splits = []
+        for markdown_document in self.load_documents():
+            parent_splits.extend(self.split_and_chunk_text(markdown_document))
+        return parent_splits
+
+    # Summaries
+
+    def load_summary_cache(self) -> Dict[str, str]:
+        cache = {}
+        if os.path.exists(BR18_SUMMARY_CACHE_PATH):
+            with open(BR18_SUMMARY_CACHE_PATH, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        cache[entry["hash"]] = entry["summary"]
+        return cache
+
+    def cache_summary(self, split_hash: str, summary: str):
+        # Append as soon as a summary is done, so an interrupted run keeps everything finished so far
+        with self._lock:
+            self.summary_cache[split_hash] = summary
+            os.makedirs(os.path.dirname(BR18_SUMMARY_CACHE_PATH), exist_ok=True)
+            with open(BR18_SUMMARY_CACHE_PATH, "a") as f:
+                f.write(json.dumps({"hash": split_hash, "summary": summary}) + "\n")
+
+    def import_legacy_summaries(self, parent_splits: List[Document]):
+        """Seed the cache from the old all-or-nothing summaries file when it lines up with the splits."""
+        if self.summary_cache or not os.path.exists(BR18_LEGACY_SUMMARIES_PATH):
+            return
+        with open(BR18_LEGACY_SUMMARIES_PATH, "r") as f:
+            legacy_summaries = json.load(f)
+        if len(legacy_summaries) != len(parent_splits):
+            print("Legacy summaries do not match the current splits, ignoring them")
+            return
+        for split, summary in zip(parent_splits, legacy_summaries):
+            self.cache_summary(content_hash(split.page_content), summary)
+
+    def generate_summaries(self, parent_splits: List[Document]) -> List[str]:
+        self.import_legacy_summaries(parent_splits)
+
+        chain = (
+            {"doc": lambda x: x.page_content}
+            | ChatPromptTemplate.from_template("Summarize the following document:\n\n{doc}")
+            | ChatOpenAI(max_retries=3)
+            | StrOutputParser()
+        )
+
+        missing_splits = {}
+        for split in parent_splits:
+            split_hash = content_hash(split.page_content)
+            if split_hash not in self.summary_cache:
+                missing_splits[split_hash] = split
+        print(f"Summaries: {len(parent_splits) - len(missing_splits)} cached, {len(missing_splits)} to generate")
+
+        def summarize(split_hash, split):
+            self.cache_summary(split_hash, chain.invoke(split))
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(summarize, split_hash, split) for split_hash, split in missing_splits.items()]
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                future.result()  # Raise on failure; finished summaries are already cached
+                if done_count % 10 == 0:
+                    print(f"Summarized {done_count}/{len(futures)}")
+
+        return [self.summary_cache[content_hash(split.page_content)] for split in parent_splits]
+
+    def generate_child_splits(self, parent_splits: List[Document], summaries: List[str]) -> List[Document]:
+        child_chunk_size = 300
+
+        child_text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=child_chunk_size, chunk_overlap=0
+        )
+
+        all_child_splits = []
+        for i, parent_split in enumerate(parent_splits):
+            child_splits = child_text_splitter.split_text(parent_split.page_content)
+
+            new_metadata = dict(parent_split.metadata)
+            new_metadata['type'] = 'children'
+
+            summary_with_prefix = f"Summary: {summaries[i]}"
+
+            first_child_content = f"{child_splits[0]}\n\n{summary_with_prefix}"
+
+            first_child_split = Document(
+            page_content=first_child_content,
+            metadata=new_metadata
+            )
+
+            all_child_splits.append(first_child_split)  # Append only the first child split (assuming it contains the metadata)
+
+        return all_child_splits
+
+    # Manifest / checkpoint
+
+    def load_manifest(self) -> Dict[str, Dict]:
+        if os.path.exists(BR18_MANIFEST_PATH):
+            with open(BR18_MANIFEST_PATH, "r") as f:
+                return json.load(f)
+        return {}
+
+    def save_manifest(self):
+        # Write to a temporary file first, so a crash never leaves a half-written manifest
+        os.makedirs(os.path.dirname(BR18_MANIFEST_PATH), exist_ok=True)
+        temp_path = f"{BR18_MANIFEST_PATH}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(temp_path, BR18_MANIFEST_PATH)
+
+    # Embedding and upsert
+
+    def get_index(self):
+        if BR18_INDEX_NAME not in pinecone.list_indexes():
+            pinecone.create_index(BR18_INDEX_NAME, dimension=1536)
+        return pinecone.Index(BR18_INDEX_NAME)
+
+    def upsert_children(self, index, child_splits: List[Document]):
+        """Embed in batches and upsert the batches in parallel, checkpointing every finished batch."""
+        batches = [child_splits[i:i + self.batch_size] for i in range(0, len(child_splits), self.batch_size)]
+
+        def embed_and_upsert(batch):
+            texts = [child.page_content for child in batch]
+            vectors = self.embeddings.embed_documents(texts)
+            index.upsert(vectors=[
+                (child.metadata[BR18_ID_KEY], vector, {**child.metadata, BR18_TEXT_KEY: child.page_content})
+                for child, vector in zip(batch, vectors)
+            ])
+            with self._lock:
+                for child in batch:
+                    self.manifest[child.metadata[BR18_ID_KEY]] = {
+                        "source": child.metadata.get("source", ""),
+                        "section": child.metadata.get("section", ""),
+                        "hash": content_hash(child.page_content),
+                    }
+                self.save_manifest()
+            return len(batch)
+
+        upserted_count = 0
+        with ThreadPoolExecutor(max_workers=self.upsert_workers) as executor:
+            futures = [executor.submit(embed_and_upsert, batch) for batch in batches]
+            for future in as_completed(futures):
+                upserted_count += future.result()
+                print(f"Upserted {upserted_count}/{len(child_splits)}")
+
+    def delete_vectors(self, index, vector_ids: List[str]):
+        for i in range(0, len(vector_ids), self.batch_size):
+            batch = vector_ids[i:i + self.batch_size]
+            index.delete(ids=batch)
+            with self._lock:
+                for vector_id in batch:
+                    self.manifest.pop(vector_id, None)
+                self.save_manifest()
+
+    def diff_sections(self, parent_splits: List[Document]) -> Dict[str, List[str]]:
+        """Compare the current sections with the manifest, by section key and content-hash id."""
+        current_ids = {split.metadata[BR18_ID_KEY] for split in parent_splits}
+        manifest_sections = {entry.get("section"): vector_id for vector_id, entry in self.manifest.items() if entry.get("section")}
+
+        diff = {"added": [], "changed": [], "removed": [], "unchanged": []}
+        for split in parent_splits:
+            doc_id = split.metadata[BR18_ID_KEY]
+            if doc_id in self.manifest:
+                diff["unchanged"].append(doc_id)
+            elif split.metadata["section"] in manifest_sections:
+                diff["changed"].append(doc_id)
+            else:
+                diff["added"].append(doc_id)
+        # Changed sections have a new id, so their old vector shows up here as well
+        diff["removed"] = [vector_id for vector_id in self.manifest if vector_id not in current_ids]
+        return diff
+
+    def reset(self):
+        """Drop every vector and checkpoint, e.g. for an index built before ids were content hashes."""
+        self.get_index().delete(delete_all=True)
+        self.manifest = {}
+        self.save_manifest()
+
+    def reset_legacy_index(self):
+        """
+        An index with vectors but no manifest was built before the manifest existed: its vectors have
+        uuid ids the sync cannot track, and would be returned next to their rebuilt copies. Start over.
+        """
+        if self.manifest:
+            return
+        vector_count = self.get_index().describe_index_stats().get("total_vector_count", 0)
+        if vector_count:
+            print(f"The index has {vector_count} vectors but there is no manifest, so it predates the sync. Rebuilding it from scratch.")
+            self.reset()
+
+    def build_clause_index(self, parent_splits: List[Document]):
+        """Index the clause numbers and headers of every parent here, so the app only has to load the result."""
+        clause_index = ClauseIndex()
+        for split in parent_splits:
+            clause_index.add_document(split.metadata[BR18_ID_KEY], split)
+        clause_index.save(BR18_PARENT_STORE_PATH)
+        print(f"Indexed {len(clause_index)} BR18 clauses")
+
+    def build(self):
+        start_time = time.perf_counter()
+
+        parent_splits = self.load_parent_splits()
+        print(f"Loaded {len(parent_splits)} parent splits from {self.folder_path}")
+
+        self.reset_legacy_index()
+
+        diff = self.diff_sections(parent_splits)
+        print(f"Sections: {len(diff['added'])} added, {len(diff['changed'])} changed, "
+              f"{len(diff['removed'])} stale vectors, {len(diff['unchanged'])} unchanged")
+
+        # Only new or changed sections are summarized and embedded
+        pending_ids = set(diff["added"]) | set(diff["changed"])
+        pending_parents = [split for split in parent_splits if split.metadata[BR18_ID_KEY] in pending_ids]
+        summaries = self.generate_summaries(pending_parents)
+        child_splits = self.generate_child_splits(pending_parents, summaries)
+
+        index = self.get_index()
+        self.upsert_children(index, child_splits)
+
+        # Swap the parents in one transaction: new vectors only resolve once their parent exists,
+        # and removed parents disappear together with the new ones appearing. All current parents
+        # are written, which also covers vectors upserted by an earlier run that stopped here.
+        # Every other parent goes, including the uuid parents imported from the old pickled store.
+        current_ids = {split.metadata[BR18_ID_KEY] for split in parent_splits}
+        stale_parent_ids = [doc_id for doc_id in self.parent_store.yield_keys() if doc_id not in current_ids]
+        self.parent_store.replace(
+            [(split.metadata[BR18_ID_KEY], split) for split in parent_splits],
+            stale_parent_ids,
+        )
+        self.delete_vectors(index, diff["removed"])
+        self.build_clause_index(parent_splits)
+
+        print(f"BR18 index synced in {time.perf_counter() - start_time:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the BR18 Pinecone index and parent docstore.")
+    parser.add_argument("--folder", default="BR18_DB", help="Folder containing the BR18 markdown files")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel summary requests")
+    parser.add_argument("--batch-size", type=int, default=100, help="Texts per embedding request and upsert")
+    parser.add_argument("--upsert-workers", type=int, default=4, help="Parallel embed-and-upsert batches")
+    parser.add_argument("--reset", action="store_true", help="Delete all vectors and the checkpoint before building")
+    args = parser.parse_args()
+
+    load_dotenv()
+    pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENV"])
+
+    builder = BR18IndexBuilder(
+        folder_path=args.folder,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        upsert_workers=args.upsert_workers,
+    )
+    if args.reset:
+        builder.reset()
+    builder.build()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Checks that a BR18 tool call makes a single Pinecone round trip and embeds the query once.
+
+    python -m agent.br18_check --latency-ms 80
+
+runs both search types against a stub vector store that sleeps for the given latency on every
+query, and exits with an error if either search type queries it or embeds the query more than once,
+or returns no documents or sources for a query that one of the stub sections answers.
+"""
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import streamlit as st
+from types import SimpleNamespace
+from typing import List
+from langchain.schema import Document
+from utility.docstore import SQLiteDocStore
+from .br18_build import BR18_ID_KEY, BR18_TEXT_KEY
+from .checks import CHECK_SECTIONS as STUB_SECTIONS, STAIRS_QUERY, KeywordEmbeddings
+from .retrieval import ClauseIndex
+from .tools import BR18_DB
+
+
+def stub_vector(text: str) -> List[float]:
+    # Related sections come out similar, so the stairs query passes the 0.75 relevance filters
+    return KeywordEmbeddings().embed(text)
+
+
+class StubPineconeIndex:
+    """Answers like pinecone.Index.query, after sleeping for the simulated round trip."""
+
+    def __init__(self, latency_seconds: float):
+        self.latency_seconds = latency_seconds
+        self.query_count = 0
+
+    def query(self, vector, top_k, include_values=False, include_metadata=False, filter=None, namespace=None):
+        self.query_count += 1
+        time.sleep(self.latency_seconds)
+        query_vector = np.array(vector)
+        matches = []
+        for i, text in enumerate(STUB_SECTIONS):
+            values = stub_vector(text)
+            matches.append({
+                "id": f"child-{i}",
+                "score": float(np.dot(query_vector, values)),
+                "values": values,
+                "metadata": {BR18_ID_KEY: f"parent-{i}", BR18_TEXT_KEY: text},
+            })
+        matches.sort(key=lambda match: match["score"], reverse=True)
+        return {"matches": matches[:top_k]}
+
+
+def build_stub_tool(latency_seconds: float, folder_path: str):
+    parent_store = SQLiteDocStore(f"{folder_path}/parents.sqlite")
+    parent_store.mset([(f"parent-{i}", Document(page_content=text, metadata={BR18_ID_KEY: f"parent-{i}"})) for i, text in enumerate(STUB_SECTIONS)])
+
+    index = StubPineconeIndex(latency_seconds)
+    embeddings = KeywordEmbeddings()
+    store = SimpleNamespace(
+        embeddings=embeddings,
+        vectorstore=SimpleNamespace(_index=index, _namespace=None, _text_key=BR18_TEXT_KEY),
+        br18_parent_store=parent_store,
+        id_key=BR18_ID_KEY,
+        clause_index=ClauseIndex(),
+    )
+    return BR18_DB(llm=None, folder_path=folder_path, store=store), index, embeddings
+
+
+def check(latency_ms: float = 80, query: str = STAIRS_QUERY) -> List[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as folder_path:
+        for search_type in ["By Context", "By Headers"]:
+            br18, index, embeddings = build_stub_tool(latency_ms / 1000, folder_path)
+            start_time = time.perf_counter()
+            st.session_state.doc_sources = []
+            docs, vector_queries = br18.retrieve(query, search_type=search_type, clause_lookup=False)
+            results.append({
+                "search_type": search_type,
+                "round_trips": index.query_count,
+                "reported_vector_queries": vector_queries,
+                "query_embeddings": embeddings.query_count,
+                "latency_ms": (time.perf_counter() - start_time) * 1000,
+                "documents": len(docs),
+                "sources": len(st.session_state.doc_sources),
+                "answers_query": any("1.0 metre" in doc.page_content for doc in docs),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that BR18 retrieval makes a single vector store round trip.")
+    parser.add_argument("--latency-ms", type=float, default=80, help="Simulated latency of one Pinecone query")
+    args = parser.parse_args()
+
+    failed = False
+    for result in check(latency_ms=args.latency_ms):
+        ok = (
+            result["round_trips"] == 1 and result["reported_vector_queries"] == 1 and result["query_embeddings"] == 1
+            and result["documents"] > 0 and result["sources"] > 0 and result["answers_query"]
+        )
+        failed = failed or not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {result['search_type']}: {result['round_trips']} round trip(s) "
+              f"(reported {result['reported_vector_queries']}), {result['query_embeddings']} query embedding(s), "
+              f"{result['latency_ms']:.0f} ms, {result['documents']} documents, {result['sources']} sources, "
+              f"{'with' if result['answers_query'] else 'without'} the answer")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
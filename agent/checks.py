@@ -0,0 +1,130 @@
+"""
+Behaviour checks that need no API keys or network, run with
+
+    python -m agent.checks
+
+Every check builds the real component with stub embeddings and raises AssertionError when it misbehaves.
+"""
+import re
+import sys
+import numpy as np
+import streamlit as st
+from types import SimpleNamespace
+from typing import List
+from langchain.embeddings.base import Embeddings
+from langchain.memory import ChatMessageHistory
+from langchain.schema import Document
+from .compressors import ContextPacker
+from .miracle import MRKL
+from .retrieval import ClauseIndex
+from .tools import DatabaseTool, ToolCascade
+
+
+CHECK_SECTIONS = [
+    "57. Stairs in shared access routes must be established with sufficient width and headroom. The free width of the stairs is minimum 1.0 metre.",
+    "58. Handrails must be installed on both sides of stairs in shared access routes. Handrails must be easy to grip.",
+    "94. An escape route is a coherent system of exits, walking areas and escape staircases. Persons must be able to leave the building safely.",
+    "96. Escape route and anti-panic lighting must be installed for the protection of use of escape routes in tall buildings.",
+    "218. Assembly rooms must have sufficient exits for the number of persons the room is designed for. Exits must be clearly marked.",
+]
+
+STAIRS_QUERY = "What is the minimum width of stairs in shared access routes?"
+
+
+class KeywordEmbeddings(Embeddings):
+    """
+    Counts of a few topic words, normalized. Texts about the same topic come out close and
+    unrelated texts almost orthogonal, like real embeddings do for these sections.
+    """
+
+    VOCABULARY = ["stairs", "width", "shared", "access", "routes", "handrails", "escape", "lighting", "exits", "assembly", "persons"]
+    OTHER_WEIGHT = 0.1  # Keeps texts without any topic word from being a zero vector
+
+    def __init__(self):
+        self.query_count = 0
+
+    def embed(self, text: str) -> List[float]:
+        words = re.findall(r"\w+", text.lower())
+        vector = np.array([words.count(word) for word in self.VOCABULARY] + [self.OTHER_WEIGHT], dtype=float)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        self.query_count += 1
+        return self.embed(text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed(text) for text in texts]
+
+
+def check_cascade_stops_at_confident_documents():
+    """A chunk that closely matches the query gives the document search enough confidence to skip the web search."""
+    tool = DatabaseTool.__new__(DatabaseTool)
+    tool.embedding = KeywordEmbeddings()
+    docs = [Document(page_content=section, metadata={"file_name": "BR18", "page_number": 1}) for section in CHECK_SECTIONS]
+
+    compressed_docs = tool.batch_compress([STAIRS_QUERY], [tool.embedding.embed_query(STAIRS_QUERY)], [docs])[0]
+    confidence = max((ContextPacker.score(doc) for doc in compressed_docs), default=0.0)
+    assert compressed_docs, "the stairs section did not pass the relevance filter"
+
+    web_searches = []
+
+    def web_search(query, callbacks=None):
+        web_searches.append(query)
+        return "", None
+
+    cascade = ToolCascade([("Document_Database", lambda query, callbacks=None: ("", confidence)), ("Web_Search", web_search)])
+    cascade.run(STAIRS_QUERY)
+    assert not web_searches, f"the cascade went on to the web search at confidence {confidence:.3f}"
+    assert st.session_state.cascade_stats["skipped"] == ["Web_Search"]
+
+
+def check_answer_cache_skips_follow_ups():
+    """A cached answer is only looked up or stored for the first question of a conversation."""
+    st.session_state.answer_cache = True
+    st.session_state.web_search = False
+    agent = MRKL.__new__(MRKL)
+    agent.memory = SimpleNamespace(chat_memory=ChatMessageHistory())
+    assert agent.use_answer_cache(), "the answer cache is not used for an opening question"
+
+    agent.memory.chat_memory.add_user_message("What is the minimum width of stairs?")
+    agent.memory.chat_memory.add_ai_message("The free width of stairs in shared access routes is minimum 1.0 metre.")
+    assert not agent.use_answer_cache(), "the answer cache is used for a follow-up question"
+
+
+def check_clause_index_skips_list_items():
+    """Numbered list items ("1. The building must ...") are not indexed as clauses, also at the start of a parent."""
+    index = ClauseIndex()
+    index.add_document("stairs", Document(
+        page_content="57. Stairs in shared access routes must fulfil the following:\n1. The building must have handrails on both sides.\n2. The free width must be minimum 1.0 metre.",
+        metadata={"source": "BR18.md"},
+    ))
+    index.add_document("handrails", Document(
+        page_content="3. The stairs must be lit.\n58. Handrails must be installed on both sides of stairs in shared access routes.",
+        metadata={"source": "BR18.md"},
+    ))
+    assert index.lookup("What does clause 1 say?") == [], "a numbered list item was indexed as clause 1"
+    assert index.lookup("What does clause 3 say?") == [], "a list item continuing in the next parent was indexed as clause 3"
+    assert index.lookup("clause 57") == ["stairs"] and index.lookup("clause 58") == ["handrails"], "a clause was not indexed"
+
+
+CHECKS = [
+    check_cascade_stops_at_confident_documents,
+    check_answer_cache_skips_follow_ups,
+    check_clause_index_skips_list_items,
+]
+
+
+def main():
+    failed = False
+    for check in CHECKS:
+        try:
+            check()
+            print(f"OK   {check.__name__}")
+        except AssertionError as e:
+            failed = True
+            print(f"FAIL {check.__name__}: {e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import re
+import tiktoken
+from typing import List, Optional, Tuple
+from langchain.docstore.document import Document
+from .retrieval import set_query_similarity
+
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "if",
+    "in", "is", "it", "of", "on", "or", "shall", "should", "that", "the", "there", "this", "to", "was",
+    "what", "when", "where", "which", "who", "why", "will", "with", "must", "about", "any",
+}
+
+
+def score_unscored(docs: List[Document], query_embedding: List[float]):
+    """Score the chunks that were filtered but never scored, from the vector they still carry."""
+    set_query_similarity([doc for doc in docs if "query_similarity_score" not in (getattr(doc, "state", None) or {})], query_embedding)
+
+
+class ExtractiveCompressor:
+    """
+    Local alternative to the retriever model. Splits the compressed chunks into sentences, scores every
+    sentence against the query and keeps the best ones that fit in a token budget.
+
+    The embedding part of the score is the chunk's query similarity, computed from the chunk vector the
+    embedding filters already stored, so no extra embedding request is made. The lexical part is the
+    share of query terms (numbers included) that the sentence contains.
+    """
+
+    def __init__(self, token_budget: int = 500, embedding_weight: float = 0.5, model_name: str = "gpt-3.5-turbo"):
+        self.token_budget = token_budget
+        self.embedding_weight = embedding_weight
+        self.encoding = tiktoken.encoding_for_model(model_name)
+
+    @staticmethod
+    def split_sentences(text: str) -> List[str]:
+        sentences = re.split(r'(?<=[.!?;])\s+|\n+', text)
+        return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return [term for term in re.findall(r"\w+", text.lower()) if term not in STOPWORDS]
+
+    @staticmethod
+    def lexical_overlap(query_terms: set, sentence_terms: set) -> float:
+        if not query_terms:
+            return 0.0
+        return len(query_terms & sentence_terms) / len(query_terms)
+
+    def score_sentences(self, docs: List[Document], query: str, query_embedding: Optional[List[float]] = None) -> List[Tuple[float, int, int, str]]:
+        if query_embedding is not None:
+            score_unscored(docs, query_embedding)
+        query_terms = set(self.tokenize(query))
+        scored = []
+        for doc_index, doc in enumerate(docs):
+            state = getattr(doc, "state", {}) or {}
+            chunk_similarity = float(state.get("query_similarity_score", 0.0))
+            for sentence_index, sentence in enumerate(self.split_sentences(doc.page_content)):
+                overlap = self.lexical_overlap(query_terms, set(self.tokenize(sentence)))
+                score = self.embedding_weight * chunk_similarity + (1 - self.embedding_weight) * overlap
+                scored.append((score, doc_index, sentence_index, sentence))
+        return scored
+
+    def select_sentences(self, docs: List[Document], query: str, query_embedding: Optional[List[float]] = None) -> List[Tuple[int, int, str]]:
+        selected = []
+        used_tokens = 0
+        seen = set()
+        for score, doc_index, sentence_index, sentence in sorted(self.score_sentences(docs, query, query_embedding), key=lambda item: item[0], reverse=True):
+            if sentence in seen:
+                continue
+            sentence_tokens = len(self.encoding.encode(sentence))
+            if used_tokens + sentence_tokens > self.token_budget:
+                continue
+            seen.add(sentence)
+            selected.append((doc_index, sentence_index, sentence))
+            used_tokens += sentence_tokens
+        # Keep the original reading order
+        return sorted(selected)
+
+    def compress(self, docs: List[Document], query: str, query_embedding: Optional[List[float]] = None) -> str:
+        sentences_by_doc = {}
+        for doc_index, _, sentence in self.select_sentences(docs, query, query_embedding):
+            sentences_by_doc.setdefault(doc_index, []).append(sentence)
+
+        if not sentences_by_doc:
+            return "There are no relevant information in the context to the query."
+
+        return "\n\n".join([f'"{" ".join(sentences)}"' for _, sentences in sorted(sentences_by_doc.items())])
+
+
+class ContextPacker:
+    """
+    Packs retrieved chunks into a token budget: highest query similarity first, near-duplicates
+    dropped, and stops once the budget is full.
+
+    BR18 parents store their token count when the index is built ("token_count" metadata), which is
+    used while "char_count" still matches the text, i.e. for whole parents; split chunks inherit
+    their parent's metadata and are counted here.
+    """
+
+    MODEL_CONTEXT_WINDOWS = {
+        "gpt-3.5-turbo": 4096,
+        "gpt-3.5-turbo-16k": 16384,
+        "gpt-3.5-turbo-instruct": 4096,
+    }
+    PROMPT_OVERHEAD = 1000  # System, formatting and reflection messages plus tool schemas
+    MIN_BUDGET = 300
+
+    def __init__(self, token_budget: int, model_name: str = "gpt-3.5-turbo", shingle_size: int = 5, overlap_threshold: float = 0.8):
+        self.token_budget = token_budget
+        self.shingle_size = shingle_size
+        self.overlap_threshold = overlap_threshold
+        self.encoding = tiktoken.encoding_for_model(model_name)
+
+    @classmethod
+    def for_model(cls, model_name: str, output_token_limit: int = 500, memory_token_limit: int = 0):
+        context_window = cls.MODEL_CONTEXT_WINDOWS.get(model_name, 4096)
+        token_budget = context_window - output_token_limit - memory_token_limit - cls.PROMPT_OVERHEAD
+        return cls(max(token_budget, cls.MIN_BUDGET), model_name=model_name)
+
+    @staticmethod
+    def score(doc: Document) -> float:
+        state = getattr(doc, "state", {}) or {}
+        return float(state.get("query_similarity_score", doc.metadata.get("score", 0.0)))
+
+    @staticmethod
+    def count_tokens_from_metadata(doc: Document):
+        if doc.metadata.get("char_count") == len(doc.page_content):
+            return doc.metadata.get("token_count")
+        return None
+
+    def count_tokens(self, doc: Document) -> int:
+        token_count = self.count_tokens_from_metadata(doc)
+        if token_count is None:
+            token_count = len(self.encoding.encode(doc.page_content))
+        return token_count
+
+    def shingles(self, text: str) -> set:
+        words = text.lower().split()
+        if len(words) < self.shingle_size:
+            return {" ".join(words)}
+        return {" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def overlaps(self, shingles: set, kept_shingles: List[set]) -> bool:
+        for other in kept_shingles:
+            # Share of the smaller chunk covered by the other one, so contained chunks count as overlapping
+            smaller = min(len(shingles), len(other)) or 1
+            if len(shingles & other) / smaller >= self.overlap_threshold:
+                return True
+        return False
+
+    def pack_documents(self, docs: List[Document], query_embedding: Optional[List[float]] = None) -> List[Document]:
+        if query_embedding is not None:
+            score_unscored(docs, query_embedding)
+        packed = []
+        kept_shingles = []
+        used_tokens = 0
+        for doc in sorted(docs, key=self.score, reverse=True):
+            shingles = self.shingles(doc.page_content)
+            if self.overlaps(shingles, kept_shingles):
+                continue
+            doc_tokens = self.count_tokens(doc)
+            if used_tokens + doc_tokens > self.token_budget:
+                continue
+            packed.append(doc)
+            kept_shingles.append(shingles)
+            used_tokens += doc_tokens
+        return packed
+
+    def pack(self, docs: List[Document], query_embedding: Optional[List[float]] = None) -> str:
+        return "\n\n".join([f'"{doc.page_content}"' for doc in self.pack_documents(docs, query_embedding)])
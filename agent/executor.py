@@ -0,0 +1,376 @@
+import re
+import json
+import time
+import threading
+import streamlit as st
+from inspect import signature
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from langchain.agents import AgentExecutor
+from langchain.agents.agent import ExceptionTool
+from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.schema import AgentAction, AgentFinish, OutputParserException
+from langchain.schema.agent import AgentActionMessageLog
+from langchain.schema.messages import AIMessage, SystemMessage
+from langchain.tools import BaseTool
+from utility.concurrency import Deadline, DeadlineExceeded, deadline_scope, submit_with_context
+
+
+class RoutedAgentExecutor(AgentExecutor):
+    """
+    AgentExecutor whose first step can be decided before the turn starts, without the planning call.
+
+    preset_route is set per turn: "conversation" answers with a plain chat completion (same prompt,
+    no tool schemas), and "document" calls preset_tool with the user input straight away. Every
+    later step is planned by the agent as usual.
+
+    deadline is also set per turn. Planning calls and tool calls then run in worker threads that
+    are only waited for until the deadline (tool calls also at most tool_timeout seconds), and once
+    it has passed the turn ends with a best-effort answer from the tool results gathered so far.
+    """
+
+    preset_route: Optional[str] = None
+    preset_tool: Optional[str] = None
+
+    deadline: Any = None
+    tool_timeout: Optional[float] = None
+    answer_grace_seconds: float = 15.0  # For the best-effort answer, after the deadline has passed
+    timed_out_tools: List[str] = []
+    budget_exceeded: bool = False
+
+    BEST_EFFORT_INSTRUCTION = """The time for this answer is up, and no more tools can be called.
+    Answer the user's last message now, using only the tool results below and the conversation so far.
+    If they do not fully answer it, give the best partial answer and say what is missing.
+
+    Tool results:
+    {tool_results}
+    """
+
+    @staticmethod
+    def run_with_deadline(fn: Callable, deadline: Optional[Deadline], *args, **kwargs):
+        """
+        Run fn in a worker thread and wait for it until the deadline. On a timeout the deadline is
+        cancelled, so the work stops at its next check, and FutureTimeoutError is raised.
+        """
+        if deadline is None:
+            return fn(*args, **kwargs)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        with deadline_scope(deadline):
+            future = submit_with_context(executor, fn, *args, **kwargs)
+        # Do not wait for the thread here: work that overruns is left to notice the cancellation
+        executor.shutdown(wait=False)
+        try:
+            return future.result(timeout=deadline.remaining())
+        except FutureTimeoutError:
+            deadline.cancel()
+            raise
+
+    def _run_action(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        agent_action: AgentAction,
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Tuple[AgentAction, str, float]:
+        start_time = time.perf_counter()
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+
+        if agent_action.tool in name_to_tool_map:
+            tool = name_to_tool_map[agent_action.tool]
+            if tool.return_direct:
+                tool_run_kwargs["llm_prefix"] = ""
+            tool_deadline = Deadline(self.tool_timeout, parent=self.deadline) if self.deadline is not None else None
+            try:
+                observation = self.run_with_deadline(
+                    tool.run,
+                    tool_deadline,
+                    agent_action.tool_input,
+                    verbose=self.verbose,
+                    color=color_mapping[agent_action.tool],
+                    callbacks=run_manager.get_child() if run_manager else None,
+                    **tool_run_kwargs,
+                )
+            except (FutureTimeoutError, DeadlineExceeded):
+                # The tool can also notice its deadline itself, just before the wait runs out
+                if tool_deadline is not None:
+                    tool_deadline.cancel()
+                self.timed_out_tools.append(agent_action.tool)
+                seconds = time.perf_counter() - start_time
+                print(f"{agent_action.tool} timed out after {seconds:.1f}s and was cancelled")
+                observation = (
+                    f"{agent_action.tool} did not finish within {seconds:.0f} seconds and was cancelled. "
+                    "Answer with the information you already have, or try a narrower input."
+                )
+        else:
+            observation = f"{agent_action.tool} is not a valid tool, try one of [{', '.join(name_to_tool_map.keys())}]."
+
+        return agent_action, observation, time.perf_counter() - start_time
+
+    def answer_conversation(self, inputs: Dict[str, str], run_manager: Optional[CallbackManagerForChainRun] = None) -> AgentFinish:
+        prompt_inputs = {key: inputs[key] for key in self.agent.prompt.input_variables if key in inputs}
+        messages = self.agent.prompt.format_prompt(**prompt_inputs, agent_scratchpad=[]).to_messages()
+        message = self.agent.llm.predict_messages(messages, callbacks=run_manager.get_child() if run_manager else None)
+        return AgentFinish(return_values={"output": message.content}, log=message.content)
+
+    def preset_action(self, inputs: Dict[str, str]) -> AgentActionMessageLog:
+        # Written as the function call the agent would have made, so its scratchpad reads naturally
+        function_call = {"name": self.preset_tool, "arguments": json.dumps({"__arg1": inputs["input"]})}
+        return AgentActionMessageLog(
+            tool=self.preset_tool,
+            tool_input=inputs["input"],
+            log=f"\nInvoking: `{self.preset_tool}` with `{inputs['input']}`\n\n\n",
+            message_log=[AIMessage(content="", additional_kwargs={"function_call": function_call})],
+        )
+
+    def answer_best_effort(
+        self,
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> AgentFinish:
+        """Final answer from the tool results so far, without tools, given a few seconds past the deadline."""
+        self.budget_exceeded = True
+        print(f"Turn deadline passed after {len(intermediate_steps)} tool calls, answering with what is there")
+
+        # Tool results go in as text, so the call works without the function schemas of either agent
+        tool_results = "\n\n".join(f"{action.tool} ({action.tool_input}):\n{observation}" for action, observation in intermediate_steps)
+        prompt_inputs = {key: inputs[key] for key in self.agent.prompt.input_variables if key in inputs}
+        messages = self.agent.prompt.format_prompt(**prompt_inputs, agent_scratchpad=[]).to_messages()
+        messages.append(SystemMessage(content=self.BEST_EFFORT_INSTRUCTION.format(tool_results=tool_results or "(none)")))
+
+        try:
+            message = self.run_with_deadline(
+                self.agent.llm.predict_messages,
+                Deadline(self.answer_grace_seconds),
+                messages,
+                callbacks=run_manager.get_child() if run_manager else None,
+                request_timeout=self.answer_grace_seconds,
+            )
+            output = message.content
+        except Exception as e:
+            print(f"Best-effort answer failed: {e}")
+            if intermediate_steps:
+                output = "I ran out of time before I could write a full answer. This is what I found so far:\n\n" + tool_results
+            else:
+                output = "I could not answer within the time limit. Please try again, or ask a narrower question."
+
+        return AgentFinish(return_values={"output": output}, log=output)
+
+    def take_routed_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Optional[Union[AgentFinish, List[Tuple[AgentAction, str]]]]:
+        """The first step of a routed turn, or None when the agent should plan it."""
+        if intermediate_steps or self.preset_route is None:
+            return None
+
+        if self.preset_route == "conversation":
+            return self.answer_conversation(inputs, run_manager)
+
+        if self.preset_route == "document" and self.preset_tool in name_to_tool_map:
+            agent_action = self.preset_action(inputs)
+            if run_manager:
+                run_manager.on_agent_action(agent_action, color="green")
+            agent_action, observation, _ = self._run_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+            return [(agent_action, observation)]
+
+        return None
+
+    def take_parsing_error_step(
+        self,
+        e: OutputParserException,
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> List[Tuple[AgentAction, str]]:
+        """Handle a planning output that could not be parsed as AgentExecutor does, following handle_parsing_errors."""
+        if isinstance(self.handle_parsing_errors, bool):
+            raise_error = not self.handle_parsing_errors
+        else:
+            raise_error = False
+        if raise_error:
+            raise ValueError(
+                "An output parsing error occurred. "
+                "In order to pass this error back to the agent and have it try "
+                "again, pass `handle_parsing_errors=True` to the AgentExecutor. "
+                f"This is the error: {str(e)}"
+            )
+
+        text = str(e)
+        if isinstance(self.handle_parsing_errors, bool):
+            if e.send_to_llm:
+                observation = str(e.observation)
+                text = str(e.llm_output)
+            else:
+                observation = "Invalid or incomplete response"
+        elif isinstance(self.handle_parsing_errors, str):
+            observation = self.handle_parsing_errors
+        elif callable(self.handle_parsing_errors):
+            observation = self.handle_parsing_errors(e)
+        else:
+            raise ValueError("Got unexpected type of `handle_parsing_errors`")
+
+        output = AgentAction("_Exception", observation, text)
+        if run_manager:
+            run_manager.on_agent_action(output, color="green")
+        observation = ExceptionTool().run(
+            output.tool_input,
+            verbose=self.verbose,
+            color=None,
+            callbacks=run_manager.get_child() if run_manager else None,
+            **self.agent.tool_run_logging_kwargs(),
+        )
+        return [(output, observation)]
+
+    def run_actions(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        actions: List[AgentAction],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> List[Tuple[AgentAction, str]]:
+        results = [self._run_action(name_to_tool_map, color_mapping, agent_action, run_manager) for agent_action in actions]
+        return [(agent_action, observation) for agent_action, observation, _ in results]
+
+    def _take_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Union[AgentFinish, List[Tuple[AgentAction, str]]]:
+        if self.deadline is not None and self.deadline.expired():
+            return self.answer_best_effort(inputs, intermediate_steps, run_manager)
+
+        routed_step = self.take_routed_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager)
+        if routed_step is not None:
+            return routed_step
+
+        try:
+            # The planning call cannot be cancelled, but the turn stops waiting for it at the deadline
+            output = self.run_with_deadline(
+                self.agent.plan,
+                self.deadline,
+                self._prepare_intermediate_steps(intermediate_steps),
+                callbacks=run_manager.get_child() if run_manager else None,
+                **inputs,
+            )
+        except FutureTimeoutError:
+            return self.answer_best_effort(inputs, intermediate_steps, run_manager)
+        except OutputParserException as e:
+            return self.take_parsing_error_step(e, run_manager)
+
+        if isinstance(output, AgentFinish):
+            return output
+
+        actions = [output] if isinstance(output, AgentAction) else output
+
+        # Announce every action from this thread first, so the callbacks see them in order
+        if run_manager:
+            for agent_action in actions:
+                run_manager.on_agent_action(agent_action, color="green")
+
+        return self.run_actions(name_to_tool_map, color_mapping, actions, run_manager)
+
+
+class ParallelAgentExecutor(RoutedAgentExecutor):
+    """
+    AgentExecutor that runs every tool call of one agent step at the same time.
+
+    Paired with OpenAIMultiFunctionsAgent, which can return several tool calls per step,
+    a step then takes as long as its slowest tool instead of the sum of all of them.
+    """
+
+    max_tool_workers: int = 4
+
+    def run_actions(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        actions: List[AgentAction],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> List[Tuple[AgentAction, str]]:
+        if len(actions) == 1:
+            agent_action, observation, _ = self._run_action(name_to_tool_map, color_mapping, actions[0], run_manager)
+            return [(agent_action, observation)]
+
+        step_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.max_tool_workers, len(actions))) as executor:
+            futures = [
+                submit_with_context(executor, self._run_action, name_to_tool_map, color_mapping, agent_action, run_manager)
+                for agent_action in actions
+            ]
+            # Keep the order the agent asked for, so the scratchpad matches its function calls
+            results = [future.result() for future in futures]
+
+        step_seconds = time.perf_counter() - step_start
+        serial_seconds = sum(seconds for _, _, seconds in results)
+        print(f"Ran {len(actions)} tools in parallel in {step_seconds:.2f}s (serial would have taken {serial_seconds:.2f}s)")
+
+        return [(agent_action, observation) for agent_action, observation, _ in results]
+
+
+class ToolResultMemo:
+    """
+    Memoizes tool results within one agent turn, keyed on the tool name and the normalized input,
+    so a repeated call returns at once instead of redoing retrieval and extraction.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+        self.turn_calls = 0
+        self.turn_hits = 0
+        self.total_calls = 0
+        self.total_hits = 0
+
+    def reset(self):
+        """Start a new turn; results never carry over, since the collection or settings may have changed."""
+        with self.lock:
+            self.results = {}
+            self.turn_calls = 0
+            self.turn_hits = 0
+
+    @staticmethod
+    def normalize(tool_input: str) -> str:
+        # Case, punctuation and spacing differences do not change what a tool returns
+        return " ".join(re.sub(r"[^\w\s§.]|(?<!\d)\.|\.(?!\d)", " ", str(tool_input).lower()).split())
+
+    def wrap(self, tool_name: str, func: Callable) -> Callable:
+        accepts_callbacks = "callbacks" in signature(func).parameters
+
+        def memoized(tool_input: str, callbacks=None):
+            key = (tool_name, self.normalize(tool_input))
+            with self.lock:
+                self.turn_calls += 1
+                self.total_calls += 1
+                cached = self.results.get(key)
+                if cached is not None:
+                    self.turn_hits += 1
+                    self.total_hits += 1
+
+            if cached is not None:
+                result, doc_sources = cached
+                print(f"{tool_name}: reusing the result for the same input from earlier in this turn")
+                # The sources shown in the chat follow the tool result
+                st.session_state.doc_sources = doc_sources
+                return result
+
+            result = func(tool_input, callbacks=callbacks) if accepts_callbacks else func(tool_input)
+            with self.lock:
+                self.results[key] = (result, st.session_state.get('doc_sources', []))
+            return result
+
+        return memoized
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "turn_calls": self.turn_calls,
+            "turn_hits": self.turn_hits,
+            "total_calls": self.total_calls,
+            "total_hits": self.total_hits,
+        }
@@ -0,0 +1,86 @@
+import re
+import numpy as np
+import streamlit as st
+from typing import Dict, List, Optional, Tuple
+from langchain.embeddings import OpenAIEmbeddings
+from .retrieval import cosine_similarities
+
+
+CONVERSATION = "conversation"
+DOCUMENT = "document"
+AGENT = "agent"  # Anything the agent should plan for itself: follow-ups, mixed or unclear requests
+
+LABELLED_EXAMPLES = {
+    CONVERSATION: [
+        "hi", "hello there", "thanks", "thank you, that was helpful", "great, thanks a lot", "ok", "bye",
+        "good morning", "who are you?", "what can you do?", "how are you today?", "nice, appreciate it",
+    ],
+    DOCUMENT: [
+        "What is the minimum width of stairs in shared access routes?",
+        "What are the fire safety requirements for escape routes?",
+        "Which requirements apply to ventilation in dwellings?",
+        "What does the document say about insulation of external walls?",
+        "List the accessibility requirements for entrances.",
+        "What is the maximum height of a handrail?",
+        "Summarize the requirements for daylight in office buildings.",
+        "How many parking spaces are required per dwelling according to the policy?",
+    ],
+    AGENT: [
+        "Can you elaborate on that?", "What about the second point?", "Explain it in simpler terms",
+        "Why is that?", "Can you give me an example of the last one?", "And for commercial buildings?",
+        "Search the web for the latest news on construction prices", "Compare that with what you said before",
+    ],
+}
+
+
+@st.cache_resource
+def get_example_embeddings() -> Dict[str, np.ndarray]:
+    """Embed the labelled examples once per process."""
+    embeddings = OpenAIEmbeddings()
+    return {label: np.array(embeddings.embed_documents(examples)) for label, examples in LABELLED_EXAMPLES.items()}
+
+
+class IntentRouter:
+    """
+    Local intent classifier for user messages: rules first, then embedding similarity to labelled examples.
+
+    Only clear cases are routed. Small talk is answered with a plain chat completion, and obvious
+    document questions go straight to retrieval; both skip the agent's planning call. Anything
+    else, including follow-ups that need the conversation, is left to the agent (None).
+    """
+
+    CONVERSATION_PATTERN = re.compile(
+        r"^\s*(hi|hello|hey|thanks|thank you|thx|ok|okay|great|perfect|nice|cool|bye|goodbye|good (morning|afternoon|evening))"
+        r"[\s,!.]*(thanks|thank you|miracle|a lot|so much)?[\s!.]*$",
+        re.IGNORECASE,
+    )
+    CLAUSE_PATTERN = re.compile(r"§\s*\d+|\b(clause|stk\.?)\s*\d+", re.IGNORECASE)
+    FOLLOW_UP_PATTERN = re.compile(r"\b(that|this|it|those|these|the last one|above|previous|before)\b\W*$|^\s*(and|but|why|what about)\b", re.IGNORECASE)
+
+    def __init__(self, similarity_threshold: float = 0.85, margin: float = 0.03):
+        self.similarity_threshold = similarity_threshold
+        self.margin = margin
+
+    def classify_by_rules(self, query: str) -> Optional[str]:
+        if self.CONVERSATION_PATTERN.match(query):
+            return CONVERSATION
+        if self.FOLLOW_UP_PATTERN.search(query):
+            return AGENT
+        if self.CLAUSE_PATTERN.search(query):
+            return DOCUMENT
+        return None
+
+    def classify_by_examples(self, query_embedding: List[float]) -> Tuple[str, float, float]:
+        scores = {label: float(np.max(cosine_similarities(example_vectors, query_embedding))) for label, example_vectors in get_example_embeddings().items()}
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        (label, score), (_, runner_up_score) = ranked[0], ranked[1]
+        return label, score, runner_up_score
+
+    def classify(self, query: str, query_embedding: List[float]) -> Optional[str]:
+        label = self.classify_by_rules(query)
+        if label is None:
+            label, score, runner_up_score = self.classify_by_examples(query_embedding)
+            if score < self.similarity_threshold or score - runner_up_score < self.margin:
+                label = AGENT
+        print(f"Intent router: {label}")
+        return None if label == AGENT else label
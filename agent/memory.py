@@ -0,0 +1,256 @@
+"""
+Agent memories with incremental token accounting, and a tiered variant that summarizes older turns.
+
+    python -m agent.memory --turns 200
+
+benchmarks it against LangChain's AgentTokenBufferMemory on a synthetic conversation.
+"""
+import time
+import argparse
+import threading
+from collections import deque
+from typing import Any, Dict, List
+from langchain.agents.format_scratchpad.openai_functions import format_to_openai_functions
+from langchain.agents.openai_functions_agent.agent_token_buffer_memory import AgentTokenBufferMemory
+from langchain.chat_models import ChatOpenAI
+from langchain.schema.messages import AIMessage, BaseMessage, FunctionMessage, HumanMessage, SystemMessage
+
+
+class IncrementalTokenBufferMemory(AgentTokenBufferMemory):
+    """
+    Drop-in AgentTokenBufferMemory that counts every message once, when it is added, and keeps
+    a running total. Pruning subtracts the cached count of the dropped message instead of
+    re-tokenizing the whole buffer after every pop.
+    """
+
+    # ChatOpenAI adds these to every conversation it counts, on top of the per-message tokens
+    PRIMING_TOKENS = 3
+
+    token_counts: Any = None
+    total_tokens: int = 0
+
+    def count_message_tokens(self, message: BaseMessage) -> int:
+        return self.llm.get_num_tokens_from_messages([message]) - self.PRIMING_TOKENS
+
+    def sync_token_counts(self):
+        """Line the cache up with the stored messages, which can change outside this memory (e.g. a cleared chat)."""
+        messages = self.chat_memory.messages
+        if self.token_counts is None or len(self.token_counts) > len(messages):
+            self.token_counts = deque()
+            self.total_tokens = 0
+        # Count only the messages added since the last sync
+        for message in messages[len(self.token_counts):]:
+            token_count = self.count_message_tokens(message)
+            self.token_counts.append(token_count)
+            self.total_tokens += token_count
+
+    def buffer_tokens(self) -> int:
+        self.sync_token_counts()
+        return self.total_tokens + self.PRIMING_TOKENS
+
+    def prune(self) -> List[BaseMessage]:
+        """Drop the oldest messages until the buffer fits, and return them."""
+        buffer = self.chat_memory.messages
+        # Count what has to go first and cut the list once; popping the front is linear per message
+        prune_count = 0
+        while prune_count < len(buffer) and self.total_tokens + self.PRIMING_TOKENS > self.max_token_limit:
+            self.total_tokens -= self.token_counts.popleft()
+            prune_count += 1
+        pruned_messages = buffer[:prune_count]
+        del buffer[:prune_count]
+        return pruned_messages
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, Any]) -> None:
+        input_str, output_str = self._get_input_output(inputs, outputs)
+        new_messages = [HumanMessage(content=input_str)]
+        new_messages.extend(format_to_openai_functions(outputs[self.intermediate_steps_key]))
+        new_messages.append(AIMessage(content=output_str))
+
+        self.sync_token_counts()
+        for message in new_messages:
+            self.chat_memory.add_message(message)
+            token_count = self.count_message_tokens(message)
+            self.token_counts.append(token_count)
+            self.total_tokens += token_count
+
+        self.prune()
+
+    def clear(self) -> None:
+        super().clear()
+        self.token_counts = deque()
+        self.total_tokens = 0
+
+
+class TieredSummaryMemory(IncrementalTokenBufferMemory):
+    """
+    Three tiers: the most recent turns verbatim (bounded by max_token_limit), a running summary of
+    everything older, and a few key facts (numbers, names, decisions) kept word for word.
+
+    Turns pruned from the buffer are folded into the summary by a background thread after the
+    answer is returned, so the summarizing call never adds to a turn's latency.
+    """
+
+    summary: str = ""
+    key_facts: List[str] = []
+    max_summary_tokens: int = 400
+    max_key_facts: int = 10
+    summary_llm: Any = None
+    pending_messages: Any = None
+    summary_lock: Any = None
+
+    SUMMARY_PROMPT = """Update the running summary of a conversation between a user and Miracle, an assistant for construction and regulatory questions.
+
+    Current summary:
+    {summary}
+
+    Current key facts:
+    {key_facts}
+
+    New lines of conversation:
+    {new_lines}
+
+    Return the updated summary in at most {max_words} words, then the updated list of at most {max_key_facts} key facts.
+    Key facts are specific details worth keeping word for word: requirement numbers, clauses, values, names, documents and decisions.
+    Use exactly this format:
+    SUMMARY:
+    <summary>
+    KEY FACTS:
+    - <fact>
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pending_messages = deque()
+        self.summary_lock = threading.Lock()
+
+    @staticmethod
+    def format_message(message: BaseMessage) -> str:
+        if isinstance(message, HumanMessage):
+            return f"User: {message.content}"
+        if isinstance(message, FunctionMessage):
+            # Tool output is long and mostly retrieved text; the answer that used it is kept anyway
+            return f"Tool result ({message.name}): {message.content[:500]}"
+        if isinstance(message, AIMessage):
+            function_call = message.additional_kwargs.get("function_call")
+            if function_call and not message.content:
+                return f"Assistant called {function_call.get('name')} with {function_call.get('arguments')}"
+            return f"Assistant: {message.content}"
+        return f"{message.type}: {message.content}"
+
+    def parse_summary(self, output: str):
+        summary_part, _, facts_part = output.partition("KEY FACTS:")
+        summary = summary_part.replace("SUMMARY:", "").strip()
+        key_facts = [line.strip().lstrip("-*").strip() for line in facts_part.splitlines() if line.strip().lstrip("-*").strip()]
+        return summary, key_facts[:self.max_key_facts]
+
+    def update_summary(self):
+        # One update at a time; turns pruned meanwhile are picked up by the loop
+        with self.summary_lock:
+            while self.pending_messages:
+                new_messages = []
+                while self.pending_messages:
+                    new_messages.append(self.pending_messages.popleft())
+
+                # Follows the agent's model, which carries the session's cache setting
+                cache = getattr(self.llm, "cache", None)
+                if self.summary_llm is None or self.summary_llm.cache != cache:
+                    self.summary_llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo", max_tokens=self.max_summary_tokens + 200, cache=cache)
+
+                prompt = self.SUMMARY_PROMPT.format(
+                    summary=self.summary or "(empty)",
+                    key_facts="\n".join(f"- {fact}" for fact in self.key_facts) or "(none)",
+                    new_lines="\n".join(self.format_message(message) for message in new_messages),
+                    max_words=int(self.max_summary_tokens * 0.75),
+                    max_key_facts=self.max_key_facts,
+                )
+                try:
+                    output = self.summary_llm.predict(prompt)
+                except Exception as e:
+                    # Put the turns back so the next update tries again
+                    print(f"Memory summary update failed: {e}")
+                    self.pending_messages.extendleft(reversed(new_messages))
+                    return
+                self.summary, self.key_facts = self.parse_summary(output)
+                print(f"Memory summary updated with {len(new_messages)} messages")
+
+    def prune(self) -> List[BaseMessage]:
+        pruned_messages = super().prune()
+        if pruned_messages:
+            self.pending_messages.extend(pruned_messages)
+            # Updates are serialized by the lock; a thread that finds nothing left to do exits
+            threading.Thread(target=self.update_summary, daemon=True).start()
+        return pruned_messages
+
+    def summary_message(self):
+        if not self.summary and not self.key_facts:
+            return None
+        content = f"Summary of the earlier conversation:\n{self.summary}"
+        if self.key_facts:
+            content += "\n\nKey facts from the earlier conversation:\n" + "\n".join(f"- {fact}" for fact in self.key_facts)
+        return SystemMessage(content=content)
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        memory_variables = super().load_memory_variables(inputs)
+        summary_message = self.summary_message()
+        if summary_message is not None:
+            buffer = memory_variables[self.memory_key]
+            if self.return_messages:
+                memory_variables[self.memory_key] = [summary_message] + list(buffer)
+            else:
+                memory_variables[self.memory_key] = f"{summary_message.content}\n\n{buffer}"
+        return memory_variables
+
+    def clear(self) -> None:
+        super().clear()
+        with self.summary_lock:
+            self.pending_messages.clear()
+            self.summary = ""
+            self.key_facts = []
+
+
+def benchmark(turns: int = 200, max_token_limit: int = 12000, model_name: str = "gpt-3.5-turbo") -> List[Dict]:
+    """Time save_context over a synthetic conversation for both memories; token counting is local."""
+    from langchain.chat_models import ChatOpenAI
+    from langchain.memory import ChatMessageHistory
+    from langchain.schema import AgentAction
+
+    llm = ChatOpenAI(model_name=model_name, openai_api_key="not-used")
+    results = []
+    for memory_class in [AgentTokenBufferMemory, IncrementalTokenBufferMemory]:
+        memory = memory_class(llm=llm, max_token_limit=max_token_limit, chat_memory=ChatMessageHistory())
+        turn_seconds = []
+        for turn in range(turns):
+            inputs = {"input": f"Question {turn}: what does clause {turn % 60} say about stair width and handrails in shared access routes?"}
+            outputs = {
+                "output": f"Answer {turn}: " + "The minimum free width is 1.0 metre and handrails are required on both sides. " * 8,
+                "intermediate_steps": [
+                    (AgentAction(tool="Document_Database", tool_input=inputs["input"], log=""), "Retrieved context. " * 60),
+                ],
+            }
+            start_time = time.perf_counter()
+            memory.save_context(inputs, outputs)
+            turn_seconds.append(time.perf_counter() - start_time)
+
+        results.append({
+            "memory": memory_class.__name__,
+            "total_seconds": sum(turn_seconds),
+            "last_turn_ms": turn_seconds[-1] * 1000,
+            "messages_kept": len(memory.chat_memory.messages),
+            "buffer_tokens": llm.get_num_tokens_from_messages(memory.chat_memory.messages),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark agent memory token accounting.")
+    parser.add_argument("--turns", type=int, default=200, help="Number of conversation turns")
+    parser.add_argument("--max-token-limit", type=int, default=12000, help="Memory token limit")
+    args = parser.parse_args()
+
+    for result in benchmark(turns=args.turns, max_token_limit=args.max_token_limit):
+        print(f"{result['memory']}: {result['total_seconds']:.2f}s total, {result['last_turn_ms']:.1f} ms last turn, "
+              f"{result['messages_kept']} messages / {result['buffer_tokens']} tokens kept")
+
+
+if __name__ == "__main__":
+    main()
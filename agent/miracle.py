@@ -1,32 +1,157 @@
 import os
+import json
+import time
+import hashlib
 import openai
+from concurrent.futures import ThreadPoolExecutor
 from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
 from langchain.callbacks import get_openai_callback
 import streamlit as st
 from langchain.memory.chat_message_histories import StreamlitChatMessageHistory
-from langchain.agents import Tool, AgentExecutor
+from langchain.agents import Tool
 from langchain.schema.messages import SystemMessage
 from langchain.agents.openai_functions_agent.base import OpenAIFunctionsAgent
-from langchain.agents.openai_functions_agent.agent_token_buffer_memory import AgentTokenBufferMemory
+from langchain.agents.openai_functions_multi_agent.base import OpenAIMultiFunctionsAgent
 from langchain.prompts import MessagesPlaceholder
-from .tools import BR18_DB, DatabaseTool, CustomGoogleSearchAPIWrapper
+from .answer_cache import get_answer_cache
+from .executor import ParallelAgentExecutor, RoutedAgentExecutor, ToolResultMemo
+from .intent import CONVERSATION, DOCUMENT, IntentRouter
+from .memory import IncrementalTokenBufferMemory, TieredSummaryMemory
+from utility.concurrency import Deadline
+from utility.llmcache import llm_cache_option
+from .tools import BR18_DB, DatabaseTool, FederatedDatabaseTool, CustomGoogleSearchAPIWrapper, SubQueryPlanner, ToolCascade
 
 class MRKL:
-    def __init__(self):
-        self.llm = ChatOpenAI(
+    def __init__(self, previous=None):
+        # Components of the previous agent, reused when their configuration has not changed
+        self.previous_components = previous.components if previous is not None else {}
+        self.previous_memory = previous.memory if previous is not None else None
+        self.components = {}
+        self.tool_memo = ToolResultMemo()
+        self.config_hash = MRKL.hash_config(MRKL.effective_config())
+
+        self.llm = self.build_component("llm", MRKL.llm_config(), lambda: ChatOpenAI(
             temperature=0, 
             streaming=st.session_state.get('streaming', True),
             model_name=st.session_state.llm_model,
             max_tokens=st.session_state.get('ouput_token_limit', 500),
-            )
+            cache=llm_cache_option(),
+            ))
         self.tools = self.load_tools()
         self.agent_executor, self.memory = self.load_agent()
 
+        # Do not keep the previous agent alive through its components
+        self.previous_components = {}
+        self.previous_memory = None
+
+    @classmethod
+    def load(cls):
+        """Return the session's agent if its configuration is unchanged, otherwise rebuild only what changed."""
+        previous = st.session_state.get('agent')
+        if isinstance(previous, cls) and previous.config_hash == cls.hash_config(cls.effective_config()):
+            return previous
+        return cls(previous=previous if isinstance(previous, cls) else None)
+
+    # Configuration
+
+    @staticmethod
+    def hash_config(config: dict) -> str:
+        return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def llm_config() -> dict:
+        return {
+            "model": st.session_state.llm_model,
+            "streaming": st.session_state.get('streaming', True),
+            "max_tokens": st.session_state.get('ouput_token_limit', 500),
+            "cache": llm_cache_option(),
+        }
+
+    @staticmethod
+    def database_config() -> dict:
+        # Vector stores are compared by identity: a new collection or ingest creates a new store object
+        federated_vector_stores = st.session_state.get('federated_vector_stores') or {}
+        return {
+            "llm": MRKL.llm_config(),
+            "federated": {name: id(store) for name, store in federated_vector_stores.items()},
+            "federated_quota": st.session_state.get('federated_quota', 3),
+            "vector_store": id(st.session_state.vector_store) if st.session_state.vector_store is not None else None,
+            "selected_document": getattr(st.session_state, 'selected_document', None),
+            "document_metadata": getattr(st.session_state, 'document_metadata', None),
+            "document_filename": getattr(st.session_state, 'document_filename', None),
+            "document_routing": st.session_state.get('document_routing', True),
+            "routing_top_documents": st.session_state.get('routing_top_documents', 3),
+        }
+
+    @staticmethod
+    def br18_config() -> dict:
+        return {"llm": MRKL.llm_config(), "enabled": st.session_state.br18_exp is True}
+
+    @staticmethod
+    def agent_config() -> dict:
+        return {
+            "web_search": st.session_state.web_search,
+            "query_planner": st.session_state.get('query_planner', False),
+            "parallel_tools": st.session_state.get('parallel_tools', False),
+            "memory_token_limit": st.session_state.get('memory_token_limit', 1300),
+            "tiered_memory": st.session_state.get('tiered_memory', False),
+            "cascade_mode": st.session_state.get('cascade_mode', False),
+            "cascade_threshold": st.session_state.get('cascade_threshold', 0.82),
+            "system_message_content": st.session_state.system_message_content,
+            "formatting_message_content": st.session_state.formatting_message_content,
+            "reflection_message_content": st.session_state.reflection_message_content,
+        }
+
+    @staticmethod
+    def effective_config() -> dict:
+        return {
+            "llm": MRKL.llm_config(),
+            "database": MRKL.database_config(),
+            "br18": MRKL.br18_config(),
+            "agent": MRKL.agent_config(),
+        }
+
+    @staticmethod
+    def answer_collections() -> list:
+        federated_vector_stores = st.session_state.get('federated_vector_stores') or {}
+        if len(federated_vector_stores) > 1:
+            return sorted(federated_vector_stores.keys())
+        if st.session_state.vector_store is not None and st.session_state.get('selected_collection_state'):
+            return [st.session_state.selected_collection_state]
+        return []
+
+    @staticmethod
+    def answer_scope() -> str:
+        """Stable across restarts, unlike config_hash, which compares vector stores by identity."""
+        return MRKL.hash_config({
+            "username": st.session_state.get('username'),
+            "collections": MRKL.answer_collections(),
+            "selected_document": getattr(st.session_state, 'selected_document', None),
+            "llm": MRKL.llm_config(),
+            "agent": MRKL.agent_config(),
+            "br18": MRKL.br18_config()["enabled"],
+            "retrieval": {key: st.session_state.get(key) for key in [
+                'search_type', 'br18_clause_lookup', 'use_retriever_model', 'use_extractive_compressor',
+                'extractive_token_budget', 'document_routing', 'routing_top_documents', 'federated_quota',
+            ]},
+        })
+
+    def build_component(self, name: str, config: dict, factory):
+        config_hash = MRKL.hash_config(config)
+        cached = self.previous_components.get(name)
+        if cached is not None and cached[0] == config_hash:
+            component = cached[1]
+        else:
+            print(f"Building agent component: {name}")
+            component = factory()
+        self.components[name] = (config_hash, component)
+        return component
+
     def conversational_tool_func(*args, **kwargs):
         return "Conversational skills activated. No action performed."
 
     def load_tools(self):
-        current_directory = os.getcwd()
         # Load tools
         tools = []
         
@@ -38,18 +163,18 @@ class MRKL:
             )
         )
 
-        llm_search = CustomGoogleSearchAPIWrapper()
+        llm_search = self.build_component("web_search", {}, CustomGoogleSearchAPIWrapper)
     
         existing_tool = next((tool for tool in tools if tool.name == 'Google_Search'), None)
         
         if st.session_state.web_search:
             if existing_tool:
-                existing_tool.func = llm_search.run
+                existing_tool.func = self.tool_memo.wrap("Google_Search", llm_search.run)
             else:
                 tools.append(
                     Tool(
                         name="Google_Search",
-                        func=llm_search.run,
+                        func=self.tool_memo.wrap("Google_Search", llm_search.run),
                         description="Useful for web search."
                     )
                 )
@@ -57,36 +182,26 @@ class MRKL:
             if existing_tool:
                 existing_tool.func = llm_search.disabled_function
 
-        if st.session_state.vector_store is not None:
-            selected_document = getattr(st.session_state, 'selected_document', None)
-            metadata = getattr(st.session_state, 'document_metadata', None)
-            file_name = getattr(st.session_state, 'document_filename', None)    
-            vector_store = st.session_state.vector_store
-            llm_database = DatabaseTool(
-                llm=self.llm, 
-                vector_store=vector_store, 
-                metadata=metadata, 
-                filename=file_name,
-                selected_document=selected_document)
+        llm_database = self.build_component("database", MRKL.database_config(), self.load_database_tool)
 
+        if llm_database is not None:
             tools.append(
                 Tool(
                     name='Document_Database',
-                    func=llm_database.run,
+                    func=self.tool_memo.wrap('Document_Database', llm_database.run),
                     description=llm_database.get_description(),
                 ),
             )
 
         #st.write(llm_database.get_description())
 
-        if st.session_state.br18_exp is True:
-            br18_folder_path = os.path.join(current_directory, "BR18_DB")
-            llm_br18 = BR18_DB(llm=self.llm, folder_path=br18_folder_path)
+        llm_br18 = self.build_component("br18", MRKL.br18_config(), self.load_br18_tool)
 
+        if llm_br18 is not None:
             tools.append(
             Tool(
                 name='BR18_Database',
-                func=llm_br18.run,
+                func=self.tool_memo.wrap('BR18_Database', llm_br18.run),
                 description="""
                 Always useful for when you need to answer questions about the Danish Building Regulation 18 (BR18). 
                 Input should be the specific keywords from the user query. Exclude the following common terms and their variations or synonyms especially words such as 'building' and 'regulation'.
@@ -95,15 +210,109 @@ class MRKL:
             )
             )
 
+        if st.session_state.get('query_planner', False):
+            planner_retrievers = {}
+            if llm_database is not None:
+                planner_retrievers['Document_Database'] = llm_database.get_compressed_documents
+            if llm_br18 is not None:
+                planner_retrievers['BR18_Database'] = llm_br18.create_retriever
+
+            if planner_retrievers:
+                planner = SubQueryPlanner(llm=self.llm, retrievers=planner_retrievers)
+                tools.append(
+                    Tool(
+                        name='Multi_Query_Database',
+                        func=self.tool_memo.wrap('Multi_Query_Database', planner.run),
+                        description=f"""
+                        Always useful for compound questions that ask about several things at once, for example several requirements or several building types.
+                        It splits the question into parts and searches {', '.join(planner_retrievers.keys())} for all parts at the same time.
+                        Input should be the full question. Use this instead of calling the database tools several times in a row.
+                        """
+                    )
+                )
+
+        if st.session_state.get('cascade_mode', False):
+            tools = self.cascade_tools(tools, llm_database, llm_br18, llm_search)
+
+        return tools
+
+    def cascade_tools(self, tools, llm_database, llm_br18, llm_search):
+        """Replace the search tools by one tool that runs them cheapest first, while the results are not confident enough."""
+        steps = []
+        if llm_database is not None:
+            steps.append(('Document_Database', lambda query, callbacks: llm_database.run_with_confidence(query, callbacks=callbacks)))
+        if llm_br18 is not None:
+            steps.append(('BR18_Database', lambda query, callbacks: llm_br18.run_with_confidence(query)))
+        if st.session_state.web_search:
+            # Web results are not scored, so the web is always the last resort
+            steps.append(('Google_Search', lambda query, callbacks: (llm_search.run(query, callbacks=callbacks), None)))
+
+        if len(steps) < 2:
+            return tools
+
+        cascade = ToolCascade(steps, confidence_threshold=st.session_state.get('cascade_threshold', 0.82))
+        step_names = [name for name, _ in steps]
+        tools = [tool for tool in tools if tool.name not in step_names]
+        tools.append(
+            Tool(
+                name='Cascading_Search',
+                func=self.tool_memo.wrap('Cascading_Search', cascade.run),
+                description=f"""
+                Always useful for questions about documents, regulations or facts. It searches {', then '.join(step_names)}, in that order,
+                and stops as soon as a source answers the question confidently, so the slower sources are only searched when needed.
+                Input should be the specific keywords from the user query.
+                """
+            )
+        )
         return tools
 
+    def load_database_tool(self):
+        federated_vector_stores = st.session_state.get('federated_vector_stores') or {}
+
+        if len(federated_vector_stores) > 1:
+            return FederatedDatabaseTool(
+                llm=self.llm,
+                vector_stores=federated_vector_stores,
+                per_collection_k=st.session_state.get('federated_quota', 3))
+
+        elif st.session_state.vector_store is not None:
+            selected_document = getattr(st.session_state, 'selected_document', None)
+            metadata = getattr(st.session_state, 'document_metadata', None)
+            file_name = getattr(st.session_state, 'document_filename', None)    
+            vector_store = st.session_state.vector_store
+            return DatabaseTool(
+                llm=self.llm, 
+                vector_store=vector_store, 
+                metadata=metadata, 
+                filename=file_name,
+                selected_document=selected_document)
+
+        return None
+
+    def load_br18_tool(self):
+        if st.session_state.br18_exp is not True:
+            return None
+
+        br18_folder_path = os.path.join(os.getcwd(), "BR18_DB")
+        try:
+            return BR18_DB(llm=self.llm, folder_path=br18_folder_path)
+        except RuntimeError as e:
+            st.error(f"BR18 is unavailable: {e}")
+            return None
+
     def load_agent(self):
         
         # Memory
         memory_token_limit = st.session_state.get('memory_token_limit', 1300)
-        chat_msg = StreamlitChatMessageHistory(key="mrkl_chat_history")
         memory_key = "history"
-        memory = AgentTokenBufferMemory(memory_key=memory_key, llm=self.llm, input_key='input', output_key="output", max_token_limit=memory_token_limit, chat_memory=chat_msg)
+        memory_class = TieredSummaryMemory if st.session_state.get('tiered_memory', False) else IncrementalTokenBufferMemory
+        if type(self.previous_memory) is memory_class and self.previous_memory.max_token_limit == memory_token_limit:
+            # Carry the conversation over to the rebuilt agent
+            memory = self.previous_memory
+            memory.llm = self.llm
+        else:
+            chat_msg = StreamlitChatMessageHistory(key="mrkl_chat_history")
+            memory = memory_class(memory_key=memory_key, llm=self.llm, input_key='input', output_key="output", max_token_limit=memory_token_limit, chat_memory=chat_msg)
         st.session_state.history = memory
 
         # System Message
@@ -128,20 +337,156 @@ class MRKL:
                 extra_prompt_messages=[formatting_message, MessagesPlaceholder(variable_name=memory_key)]
             )
 
-        # Agent
-        agent = OpenAIFunctionsAgent(llm=self.llm, tools=self.tools, prompt=prompt)
-        
-        # Agent Executor
-        agent_executor = AgentExecutor.from_agent_and_tools(agent=agent, tools=self.tools, memory=memory, verbose=True, return_intermediate_steps=True)
+        # Agent and Agent Executor
+        if st.session_state.get('parallel_tools', False):
+            # The multi-function agent can call several tools in one step, and they run concurrently
+            agent = OpenAIMultiFunctionsAgent(llm=self.llm, tools=self.tools, prompt=prompt)
+            agent_executor = ParallelAgentExecutor.from_agent_and_tools(agent=agent, tools=self.tools, memory=memory, verbose=True, return_intermediate_steps=True)
+        else:
+            agent = OpenAIFunctionsAgent(llm=self.llm, tools=self.tools, prompt=prompt)
+            agent_executor = RoutedAgentExecutor.from_agent_and_tools(agent=agent, tools=self.tools, memory=memory, verbose=True, return_intermediate_steps=True)
         
         return agent_executor, memory
 
     def clear_conversation(self):
         self.memory.clear()
 
+    def has_history(self):
+        # The tiered memory also remembers turns it has pruned, summarized or not yet
+        memory = self.memory
+        return bool(memory.chat_memory.messages or getattr(memory, "summary", None) or getattr(memory, "pending_messages", None))
+
+    def use_answer_cache(self):
+        # Web results change over time, so answers that may rely on them are not cached.
+        # A follow-up means something else in another conversation, so only opening questions are
+        return st.session_state.get('answer_cache', False) and not st.session_state.web_search and not self.has_history()
+
+    def lookup_cached_answer(self, input, query_embedding):
+        match = get_answer_cache().lookup(query_embedding, MRKL.answer_scope(), st.session_state.get('answer_cache_threshold', 0.95))
+        if match is None:
+            return None
+
+        answer, sources, similarity, cached_query = match
+        print(f"Answer cache hit ({similarity:.3f}), answered before as: {cached_query}")
+        st.session_state.doc_sources = sources
+        # Keep the conversation going as if the agent had answered
+        self.memory.save_context({"input": input}, {"output": answer, "intermediate_steps": []})
+        return {"input": input, "output": answer, "intermediate_steps": [], "cached_answer": {"query": cached_query, "similarity": similarity}}
+
+    def store_answer(self, input, query_embedding, result):
+        # Only answers grounded in a retrieval are cached, not small talk or follow-ups answered from memory
+        used_tools = [action.tool for action, _ in result.get('intermediate_steps', [])]
+        if not any(tool != 'Conversational_Tool' for tool in used_tools):
+            return
+        get_answer_cache().store(
+            input, query_embedding, MRKL.answer_scope(), MRKL.answer_collections(),
+            result.get('output', ''), st.session_state.doc_sources or [],
+        )
+
+    def route_tool(self, input):
+        tool_names = [tool.name for tool in self.tools]
+        if 'Cascading_Search' in tool_names:
+            return 'Cascading_Search'
+        # Clause references are BR18's; other document questions go to the loaded collection first
+        if 'BR18_Database' in tool_names and IntentRouter.CLAUSE_PATTERN.search(input):
+            return 'BR18_Database'
+        for tool_name in ['Document_Database', 'BR18_Database']:
+            if tool_name in tool_names:
+                return tool_name
+        return None
+
+    def set_route(self, input, query_embedding):
+        """Decide the first step locally when the intent is obvious; otherwise leave it to the agent."""
+        self.agent_executor.preset_route = None
+        self.agent_executor.preset_tool = None
+        st.session_state.last_route = None
+        if query_embedding is None:
+            return
+
+        route = IntentRouter().classify(input, query_embedding)
+        if route == CONVERSATION:
+            self.agent_executor.preset_route = CONVERSATION
+        elif route == DOCUMENT:
+            route_tool = self.route_tool(input)
+            if route_tool is not None:
+                self.agent_executor.preset_route = DOCUMENT
+                self.agent_executor.preset_tool = route_tool
+        st.session_state.last_route = self.agent_executor.preset_tool or self.agent_executor.preset_route
+
+    def start_speculative_retrieval(self, input, executor):
+        """Retrieve for the raw input while the first planning call is in flight, when the agent will plan it."""
+        llm_database = self.components.get("database", (None, None))[1]
+        if llm_database is None or not st.session_state.get('speculative_retrieval', False):
+            return None
+        if self.agent_executor.preset_route is not None:
+            return None  # Routed turns call the tool (or no tool) right away
+        llm_database.prefetch(input, executor)
+        return llm_database
+
+    def start_deadline(self):
+        """Give the turn its latency budget; each tool call also gets its own timeout within it."""
+        executor = self.agent_executor
+        executor.timed_out_tools = []
+        executor.budget_exceeded = False
+        if not st.session_state.get('turn_deadline', False):
+            executor.deadline = None
+            return None
+        executor.tool_timeout = st.session_state.get('tool_timeout_seconds', 30)
+        executor.deadline = Deadline(st.session_state.get('turn_budget_seconds', 60))
+        return executor.deadline
+
+    def record_deadline_stats(self, turn_seconds):
+        executor = self.agent_executor
+        previous_stats = st.session_state.get('deadline_stats') or {}
+        st.session_state.deadline_stats = {
+            "turn_seconds": turn_seconds,
+            "budget_seconds": st.session_state.get('turn_budget_seconds', 60) if executor.deadline is not None else None,
+            "timed_out_tools": list(executor.timed_out_tools),
+            "budget_exceeded": executor.budget_exceeded,
+            "total_tool_timeouts": previous_stats.get('total_tool_timeouts', 0) + len(executor.timed_out_tools),
+            "total_budget_overruns": previous_stats.get('total_budget_overruns', 0) + int(executor.budget_exceeded),
+        }
+
     def run_agent(self, input, callbacks=[]):
+        self.tool_memo.reset()
+        st.session_state.speculative_stats = {}
+        st.session_state.cascade_stats = {}
+        start_time = time.perf_counter()
+        deadline = self.start_deadline()
         with get_openai_callback() as cb:
-            result = self.agent_executor({"input": input}, callbacks=callbacks)
+            result = None
+            query_embedding = None
+            # Decided before the turn, which adds itself to the history
+            use_answer_cache = self.use_answer_cache()
+            # One embedding of the input serves both the answer cache and the intent router
+            if use_answer_cache or st.session_state.get('local_router', False):
+                query_embedding = OpenAIEmbeddings().embed_query(input)
+
+            if use_answer_cache:
+                result = self.lookup_cached_answer(input, query_embedding)
+
+            if result is None:
+                self.set_route(input, query_embedding if st.session_state.get('local_router', False) else None)
+
+                speculative_executor = ThreadPoolExecutor(max_workers=1)
+                speculative_database = self.start_speculative_retrieval(input, speculative_executor)
+                try:
+                    result = self.agent_executor({"input": input}, callbacks=callbacks)
+                finally:
+                    if deadline is not None:
+                        # Tool calls that are still running stop at their next check
+                        deadline.cancel()
+                    if speculative_database is not None:
+                        speculative_database.discard_prefetched()
+                    speculative_executor.shutdown(wait=False)
+
+                # A best-effort answer after a timeout is not worth repeating
+                timed_out = self.agent_executor.budget_exceeded or self.agent_executor.timed_out_tools
+                if use_answer_cache and not timed_out:
+                    self.store_answer(input, query_embedding, result)
+
             st.session_state.token_count = cb
+            st.session_state.tool_memo_stats = self.tool_memo.stats()
+            self.record_deadline_stats(time.perf_counter() - start_time)
             print(cb)
         return result
\ No newline at end of file
@@ -0,0 +1,374 @@
+import re
+import sqlite3
+import numpy as np
+from typing import Dict, List, Optional, Set, Tuple
+from langchain.embeddings.base import Embeddings
+from langchain.document_transformers.embeddings_redundant_filter import _DocumentWithState
+
+
+ROUTING_SUFFIX = "_routing"
+# Set on every routing collection, so a user collection that happens to end in the suffix is never taken for one
+ROUTING_METADATA_KEY = "mrkl:routing_index"
+
+
+def routing_collection_name(collection_name: str) -> str:
+    return f"{collection_name}{ROUTING_SUFFIX}"
+
+
+def is_routing_collection(collection) -> bool:
+    return bool((collection.metadata or {}).get(ROUTING_METADATA_KEY))
+
+
+def file_name_filter(file_names: List[str]) -> dict:
+    # Chroma's $or needs at least two clauses
+    if len(file_names) == 1:
+        return {"file_name": {"$eq": file_names[0]}}
+    return {"$or": [{"file_name": {"$eq": file_name}} for file_name in file_names]}
+
+
+class DocumentRouter:
+    """
+    Document-level routing index stored next to a page collection.
+
+    Each entry is the normalized centroid of a document's page embeddings, so a query
+    can first pick the closest documents and then only search their pages.
+    """
+
+    def __init__(self, client, collection_name: str):
+        self.client = client
+        self.collection_name = collection_name
+        self.collection = self.find_collection(client, collection_name)
+        if self.collection is None:
+            self.collection = client.create_collection(
+                name=routing_collection_name(collection_name),
+                metadata={"hnsw:space": "cosine", ROUTING_METADATA_KEY: True}
+            )
+
+    @staticmethod
+    def find_collection(client, collection_name: str):
+        """The routing collection of a page collection, or None. Raises ValueError if a user collection has its name."""
+        name = routing_collection_name(collection_name)
+        for collection in client.list_collections():
+            if collection.name == name:
+                if not is_routing_collection(collection):
+                    raise ValueError(f"'{name}' is a user collection, not the routing index of '{collection_name}'")
+                return collection
+        return None
+
+    @classmethod
+    def load(cls, client, collection_name: str) -> Optional["DocumentRouter"]:
+        """Return the router of an existing routing collection, or None if it was never built."""
+        try:
+            if cls.find_collection(client, collection_name) is None:
+                return None
+        except ValueError as e:
+            print(f"Document routing unavailable: {e}")
+            return None
+        return cls(client, collection_name)
+
+    @classmethod
+    def delete_index(cls, client, collection_name: str):
+        """Delete the routing collection of a page collection that is deleted, if it has one."""
+        try:
+            collection = cls.find_collection(client, collection_name)
+        except ValueError:
+            return
+        if collection is not None:
+            client.delete_collection(collection.name)
+
+    @classmethod
+    def rename_index(cls, client, collection_name: str, new_collection_name: str):
+        """Follow a renamed page collection with its routing collection, if it has one."""
+        try:
+            collection = cls.find_collection(client, collection_name)
+        except ValueError:
+            return
+        if collection is not None:
+            collection.modify(name=routing_collection_name(new_collection_name))
+
+    @staticmethod
+    def centroid(page_embeddings: List[List[float]]) -> List[float]:
+        centroid = np.mean(np.array(page_embeddings), axis=0)
+        norm = np.linalg.norm(centroid)
+        if norm > 0:
+            centroid = centroid / norm
+        return centroid.tolist()
+
+    def add_document(self, file_name: str, page_embeddings: List[List[float]]):
+        if not page_embeddings:
+            return
+        self.collection.upsert(
+            ids=[file_name],
+            embeddings=[self.centroid(page_embeddings)],
+            metadatas=[{"file_name": file_name, "page_count": len(page_embeddings)}],
+            documents=[file_name],
+        )
+
+    def remove_document(self, file_name: str):
+        self.collection.delete(ids=[file_name])
+
+    def refresh_document(self, page_collection, file_name: str):
+        """Recompute a document's centroid from the page embeddings still stored in the collection."""
+        pages = page_collection.get(where={"file_name": {"$eq": file_name}}, include=["embeddings"])
+        page_embeddings = pages.get("embeddings") or []
+        if page_embeddings:
+            self.add_document(file_name, page_embeddings)
+        else:
+            self.remove_document(file_name)
+
+    def rebuild(self, page_collection):
+        """Backfill the routing index for every document already stored in the page collection."""
+        pages = page_collection.get(include=["embeddings", "metadatas"])
+        embeddings_by_file = {}
+        for embedding, metadata in zip(pages.get("embeddings") or [], pages.get("metadatas") or []):
+            file_name = (metadata or {}).get("file_name")
+            if file_name:
+                embeddings_by_file.setdefault(file_name, []).append(embedding)
+
+        existing_ids = self.collection.get(include=[]).get("ids", [])
+        stale_ids = [doc_id for doc_id in existing_ids if doc_id not in embeddings_by_file]
+        if stale_ids:
+            self.collection.delete(ids=stale_ids)
+
+        for file_name, page_embeddings in embeddings_by_file.items():
+            self.add_document(file_name, page_embeddings)
+
+        return len(embeddings_by_file)
+
+    def document_count(self) -> int:
+        return self.collection.count()
+
+    def page_count(self) -> int:
+        metadatas = self.collection.get(include=["metadatas"]).get("metadatas") or []
+        return sum((metadata or {}).get("page_count", 0) for metadata in metadatas)
+
+    def is_complete(self, page_collection) -> bool:
+        """The router is only trusted when it covers every page of the collection."""
+        return self.page_count() == page_collection.count()
+
+    def route_batch(self, query_embeddings: List[List[float]], n_documents: int = 3) -> List[List[str]]:
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=min(n_documents, self.document_count()),
+            include=["metadatas"],
+        )
+        metadatas = results.get("metadatas") or [[] for _ in query_embeddings]
+        return [[metadata["file_name"] for metadata in query_metadatas if metadata] for query_metadatas in metadatas]
+
+    def route(self, query_embedding: List[float], n_documents: int = 3) -> List[str]:
+        return self.route_batch([query_embedding], n_documents)[0]
+
+
+class QueryEmbeddingCache(Embeddings):
+    """
+    Wraps an embeddings model so a query embedded once is reused by every filter
+    that needs it during the same tool call.
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self.query_embeddings = {}
+
+    def set_query_embedding(self, text: str, embedding: List[float]):
+        self.query_embeddings[text] = embedding
+
+    def embed_query(self, text: str) -> List[float]:
+        if text not in self.query_embeddings:
+            self.query_embeddings[text] = self.embeddings.embed_query(text)
+        return self.query_embeddings[text]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+
+def cosine_similarities(vectors, query_embedding: List[float]) -> np.ndarray:
+    """Cosine similarity of every row of vectors to the query, for OpenAI embeddings."""
+    # OpenAI embeddings are unit length, so the dot product is the cosine similarity
+    return np.asarray(vectors) @ np.asarray(query_embedding)
+
+
+def set_query_similarity(docs: List[_DocumentWithState], query_embedding: List[float]) -> List[_DocumentWithState]:
+    """
+    Store every document's similarity to the query under "query_similarity_score", from the vector
+    the embedding filters left in its state. LangChain's EmbeddingsFilter does not keep the score,
+    and split chunks lose the one the vector store returned for their parent.
+    """
+    embedded_docs = [doc for doc in docs if "embedded_doc" in (getattr(doc, "state", None) or {})]
+    if embedded_docs:
+        scores = cosine_similarities([doc.state["embedded_doc"] for doc in embedded_docs], query_embedding)
+        for doc, score in zip(embedded_docs, scores):
+            doc.state["query_similarity_score"] = float(score)
+    return docs
+
+
+def query_pinecone_with_values(vectorstore, query_embedding: List[float], k: int, filter: Optional[dict] = None) -> List[_DocumentWithState]:
+    """
+    Query a LangChain Pinecone store and keep the stored vector and score of every match.
+
+    The vector is put in the document state under "embedded_doc", which is where
+    LangChain's EmbeddingsFilter and EmbeddingsRedundantFilter look before embedding.
+    """
+    results = vectorstore._index.query(
+        vector=query_embedding,
+        top_k=k,
+        include_values=True,
+        include_metadata=True,
+        filter=filter,
+        namespace=vectorstore._namespace,
+    )
+
+    docs = []
+    for match in results["matches"]:
+        metadata = dict(match["metadata"])
+        text = metadata.pop(vectorstore._text_key, "")
+        docs.append(
+            _DocumentWithState(
+                page_content=text,
+                metadata=metadata,
+                state={"embedded_doc": match["values"], "query_similarity_score": match["score"]},
+            )
+        )
+    return docs
+
+
+class ClauseIndex:
+    """
+    Exact lookup of BR18 parents by clause number ("§ 57, stk. 1", "clause 57.1") or section header.
+
+    Built offline with the parents (agent.br18_build) and stored in their SQLite file, so starting
+    the app only reads the index instead of scanning every parent. BR18 numbers its clauses at the
+    start of a line ("57. Stairs in shared access routes ..."), with subsections ("(2) ...") and items
+    ("1) ...") below them; every clause is indexed, and so is every subsection and item under it.
+    Clause numbers only go up through the regulation, so parents are added in reading order and a
+    "N." line that does not continue the numbering is an item of a numbered list ("1. The building
+    must ..."), not a clause. "§ N" in the text is not indexed, since it only appears in
+    cross-references to other clauses. Lookups are plain dictionary reads.
+    """
+
+    HEADER_KEYS = ["Header 1", "Header 2", "Header 3", "Header 4"]
+
+    # Text must follow on the same line: a wrapped cross-reference can leave a bare "25." line
+    PARAGRAPH_PATTERN = re.compile(r"^(\d+)([a-z]?)\.[ \t]+\S", re.IGNORECASE | re.MULTILINE)
+    SUBSECTION_PATTERN = re.compile(r"^\s*\((\d+)\)|^\s*(\d+)\)", re.MULTILINE)
+    QUERY_PATTERN = re.compile(
+        r"(?:§\s*|\b(?:clause|paragraph)\s+)(\d+[a-z]?)"
+        r"(?:\.(\d+)|\s*\((\d+)\)|\s*,?\s*(?:stk\.?|subsection|subclause)\s*(\d+))?",
+        re.IGNORECASE,
+    )
+    SECTION_WORDS = re.compile(r"\b(?:section|chapter|part|afsnit|kapitel)\b", re.IGNORECASE)
+
+    def __init__(self):
+        self.clauses: Dict[Tuple[str, Optional[str]], List[str]] = {}
+        self.headers: Dict[str, Set[str]] = {}
+        # Last clause number seen per source file, while the parents are added in reading order
+        self.last_paragraphs: Dict[str, Tuple[int, str]] = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = re.sub(r"^section:\s*", "", text.strip(), flags=re.IGNORECASE)
+        return " ".join(text.lower().split())
+
+    def add(self, key: Tuple[str, Optional[str]], doc_id: str):
+        doc_ids = self.clauses.setdefault(key, [])
+        if doc_id not in doc_ids:
+            doc_ids.append(doc_id)
+
+    def add_document(self, doc_id: str, doc):
+        for header_key in self.HEADER_KEYS:
+            header = doc.metadata.get(header_key)
+            if header:
+                self.headers.setdefault(self.normalize(header), set()).add(doc_id)
+
+        # Walk the markers in reading order, so a subsection belongs to the last clause before it
+        markers = [(match.start(), "paragraph", (int(match.group(1)), match.group(2).lower())) for match in self.PARAGRAPH_PATTERN.finditer(doc.page_content)]
+        markers += [(match.start(), "subsection", match.group(1) or match.group(2)) for match in self.SUBSECTION_PATTERN.finditer(doc.page_content)]
+
+        source = doc.metadata.get("source", "")
+        paragraph = None
+        for _, kind, number in sorted(markers):
+            if kind == "paragraph":
+                last_paragraph = self.last_paragraphs.get(source)
+                if last_paragraph is None or number > last_paragraph:
+                    self.last_paragraphs[source] = number
+                    paragraph = f"{number[0]}{number[1]}"
+                    self.add((paragraph, None), doc_id)
+                    continue
+                # A numbered list item, counted as an item of the clause it is in
+                number = str(number[0])
+            if paragraph is not None:
+                self.add((paragraph, number), doc_id)
+
+    def save(self, path: str):
+        """Replace the stored index in one transaction, so readers see either the old or the new one."""
+        connection = sqlite3.connect(path)
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS clauses (paragraph TEXT NOT NULL, subsection TEXT, doc_id TEXT NOT NULL)")
+                connection.execute("CREATE TABLE IF NOT EXISTS clause_headers (header TEXT NOT NULL, doc_id TEXT NOT NULL)")
+                connection.execute("DELETE FROM clauses")
+                connection.execute("DELETE FROM clause_headers")
+                connection.executemany(
+                    "INSERT INTO clauses (paragraph, subsection, doc_id) VALUES (?, ?, ?)",
+                    [(paragraph, subsection, doc_id) for (paragraph, subsection), doc_ids in self.clauses.items() for doc_id in doc_ids],
+                )
+                connection.executemany(
+                    "INSERT INTO clause_headers (header, doc_id) VALUES (?, ?)",
+                    [(header, doc_id) for header, doc_ids in self.headers.items() for doc_id in sorted(doc_ids)],
+                )
+        finally:
+            connection.close()
+
+    @classmethod
+    def load(cls, path: str) -> Optional["ClauseIndex"]:
+        """The index stored next to the parents, or None if it has not been built yet."""
+        connection = sqlite3.connect(path)
+        try:
+            if connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'clauses'").fetchone() is None:
+                return None
+            index = cls()
+            # Row order keeps the parents of a clause in reading order
+            for paragraph, subsection, doc_id in connection.execute("SELECT paragraph, subsection, doc_id FROM clauses ORDER BY rowid"):
+                index.add((paragraph, subsection), doc_id)
+            for header, doc_id in connection.execute("SELECT header, doc_id FROM clause_headers"):
+                index.headers.setdefault(header, set()).add(doc_id)
+            return index
+        finally:
+            connection.close()
+
+    @classmethod
+    def from_docstore(cls, docstore, batch_size: int = 500) -> "ClauseIndex":
+        index = cls()
+        keys = list(docstore.yield_keys())
+        for i in range(0, len(keys), batch_size):
+            batch_keys = keys[i:i + batch_size]
+            for doc_id, doc in zip(batch_keys, docstore.mget(batch_keys)):
+                if doc is not None:
+                    index.add_document(doc_id, doc)
+        return index
+
+    def parse_query(self, query: str) -> List[Tuple[str, Optional[str]]]:
+        references = []
+        for match in self.QUERY_PATTERN.finditer(query):
+            paragraph = match.group(1).lower()
+            subsection = match.group(2) or match.group(3) or match.group(4)
+            references.append((paragraph, subsection))
+        return references
+
+    def lookup(self, query: str) -> List[str]:
+        """Return the ids of the parents a query explicitly refers to, or an empty list."""
+        doc_ids = []
+        for paragraph, subsection in self.parse_query(query):
+            # Fall back to the whole paragraph when the subsection is not marked in the text
+            matches = self.clauses.get((paragraph, subsection)) or self.clauses.get((paragraph, None), [])
+            doc_ids.extend(doc_id for doc_id in matches if doc_id not in doc_ids)
+
+        if not doc_ids and self.SECTION_WORDS.search(query):
+            normalized_query = self.normalize(query)
+            for header, header_doc_ids in self.headers.items():
+                # Short headers such as "General" would match almost any query
+                if len(header) > 3 and re.search(rf"\b{re.escape(header)}\b", normalized_query):
+                    doc_ids.extend(doc_id for doc_id in sorted(header_doc_ids) if doc_id not in doc_ids)
+        return doc_ids
+
+    def __len__(self):
+        return len(self.clauses)
@@ -4,32 +4,115 @@ from langchain.document_loaders import SeleniumURLLoader
 from bs4 import BeautifulSoup
 from langchain.utilities import GoogleSearchAPIWrapper
 from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utility.concurrency import DeadlineExceeded, check_deadline, current_deadline, submit_with_context
 import streamlit as st
 from langchain.docstore.document import Document
 import pytz
 from datetime import datetime
 from langchain.embeddings import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter, CharacterTextSplitter
+from langchain.text_splitter import CharacterTextSplitter
 from langchain.document_transformers import EmbeddingsRedundantFilter
 from langchain.retrievers.document_compressors import EmbeddingsFilter
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import DocumentCompressorPipeline, LLMChainFilter
-from langchain.storage import InMemoryStore
 import lark
 import pinecone
 from langchain.vectorstores import Pinecone
-import pickle
-from langchain.document_loaders import TextLoader
-from pathlib import Path
+import resource
+from utility.docstore import SQLiteDocStore
+from utility.llmcache import active_llm_cache, llm_cache_option
+from .br18_build import BR18_INDEX_NAME, BR18_ID_KEY, BR18_TEXT_KEY, BR18_PARENT_STORE_PATH
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.output_parser import StrOutputParser
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chains.summarize import load_summarize_chain
 from langchain.prompts.prompt import PromptTemplate
-from langchain.retrievers.multi_vector import MultiVectorRetriever
-import uuid
 from langchain.chat_models import ChatOpenAI
+from langchain.callbacks.manager import CallbackManager
+from langchain.schema import Generation, LLMResult
 import json
+import numpy as np
+import time
+from langchain.document_transformers.embeddings_redundant_filter import _DocumentWithState
+from .compressors import ContextPacker, ExtractiveCompressor
+from .memory import TieredSummaryMemory
+from .retrieval import ClauseIndex, DocumentRouter, QueryEmbeddingCache, file_name_filter, query_pinecone_with_values, set_query_similarity
+
+
+def get_context_packer():
+    # Tool output shares the agent's window with the prompt, the memory and the answer
+    memory_token_limit = st.session_state.get('memory_token_limit', 1300)
+    if st.session_state.get('tiered_memory', False):
+        memory_token_limit += TieredSummaryMemory.__fields__["max_summary_tokens"].default
+    return ContextPacker.for_model(
+        st.session_state.get('llm_model', "gpt-3.5-turbo"),
+        output_token_limit=st.session_state.get('ouput_token_limit', 500),
+        memory_token_limit=memory_token_limit,
+    )
+
+
+def stream_completion(prompt: str, max_tokens: int, tool_name: str, callbacks=None, model_name: str = "gpt-3.5-turbo-instruct") -> str:
+    """
+    Stream a completion through the LangChain callbacks, so the tokens show up in the chat
+    while they are generated, and record the tool's time to first token.
+    """
+    callback_manager = CallbackManager.configure(inheritable_callbacks=callbacks)
+    run_manager = callback_manager.on_llm_start({"name": model_name}, [prompt])[0]
+
+    start_time = time.perf_counter()
+    first_token_seconds = None
+    tokens = []
+    # A tool call that runs out of time stops streaming at the next token
+    deadline = current_deadline()
+
+    llm_cache = active_llm_cache()
+    cached_output = llm_cache.lookup_completion(prompt, model_name, max_tokens=max_tokens, temperature=0) if llm_cache else None
+
+    if cached_output is not None:
+        # Sent as one token, so the chat still shows the text
+        first_token_seconds = time.perf_counter() - start_time
+        tokens.append(cached_output)
+        run_manager.on_llm_new_token(cached_output)
+    else:
+        try:
+            # An expired deadline raises here rather than reaching openai as a non-positive timeout
+            check_deadline()
+            request_timeout = deadline.remaining() if deadline is not None else None
+            response = openai.Completion.create(
+                engine=model_name,
+                prompt=prompt,
+                max_tokens=max_tokens,
+                temperature=0,
+                stream=True,
+                request_timeout=request_timeout,
+            )
+            for chunk in response:
+                check_deadline()
+                token = chunk.choices[0].text
+                if not token:
+                    continue
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - start_time
+                tokens.append(token)
+                run_manager.on_llm_new_token(token)
+        except (openai.error.OpenAIError, DeadlineExceeded) as e:
+            run_manager.on_llm_error(e)
+            raise
+
+        if llm_cache:
+            llm_cache.update_completion(prompt, "".join(tokens), model_name, max_tokens=max_tokens, temperature=0)
+
+    output = "".join(tokens)
+    run_manager.on_llm_end(LLMResult(generations=[[Generation(text=output)]]))
+
+    total_seconds = time.perf_counter() - start_time
+    st.session_state.setdefault('tool_latency', {})[tool_name] = {
+        "time_to_first_token": first_token_seconds,
+        "total": total_seconds,
+    }
+    print(f"{tool_name}: first token after {first_token_seconds or 0:.2f}s, done after {total_seconds:.2f}s")
+    return output.strip()
 
 
 class CustomGoogleSearchAPIWrapper(GoogleSearchAPIWrapper):
@@ -72,6 +155,8 @@ class CustomGoogleSearchAPIWrapper(GoogleSearchAPIWrapper):
         formatted_search_results = []
 
         for result in metadata_results:
+            # Each page load can take seconds, so stop between pages once the tool call has run out of time
+            check_deadline()
             url = result.get("link", "")
             title = result.get("title", "")  # Get the title from metadata
             scraped_content = self.scrape_content(url, title) 
@@ -80,7 +165,7 @@ class CustomGoogleSearchAPIWrapper(GoogleSearchAPIWrapper):
         
         return formatted_search_results, metadata_results
     
-    def run(self, query: str, num_results: int = 3):
+    def run(self, query: str, num_results: int = 3, callbacks=None):
         
         num_results = st.session_state.websearch_results
 
@@ -144,15 +229,8 @@ class CustomGoogleSearchAPIWrapper(GoogleSearchAPIWrapper):
         """
 
         try:
-            response = openai.Completion.create(
-                engine="gpt-3.5-turbo-instruct",  
-                prompt=prompt_template,
-                max_tokens=300,  # You can adjust as needed
-                temperature=0  # You can adjust as needed
-            )
-
-            # Extract and Process the Response
-            output = response.choices[0].text.strip()
+            # Streamed, so the extraction shows up in the chat while it is generated
+            output = stream_completion(prompt_template, max_tokens=300, tool_name="Google_Search", callbacks=callbacks)
 
         except openai.error.OpenAIError as e:
             # Handle the exception according to your needs.
@@ -166,6 +244,9 @@ class CustomGoogleSearchAPIWrapper(GoogleSearchAPIWrapper):
     
 
 class DatabaseTool:
+    # Retriever model calls run side by side in batch_run; more at once only hits the rate limit
+    max_batch_workers = 4
+
     def __init__(self, llm, vector_store, metadata=None, filename=None, selected_document=None):
         self.llm = llm
         self.vector_store = vector_store
@@ -173,6 +254,9 @@ class DatabaseTool:
         self.filename = filename
         self.selected_document = selected_document
         self.embedding = OpenAIEmbeddings()
+        self.routing_top_documents = st.session_state.get('routing_top_documents', 3)
+        self.router = self.load_document_router(self.vector_store)
+        self.prefetched = None
 
     def get_description(self):
         #NEED TO BE REVIEW AGAIN
@@ -202,17 +286,56 @@ class DatabaseTool:
             no_title_description = f"This tool is currently loaded with the document '{filename}'"
             return f"{base_description} {no_title_description}. {footer_description}"
 
+    def load_document_router(self, vector_store):
+        # Routing is pointless when the search is already limited to one document
+        if self.selected_document or not st.session_state.get('document_routing', True):
+            return None
+        try:
+            page_collection = vector_store._collection
+            router = DocumentRouter.load(vector_store._client, page_collection.name)
+            if router is None or not router.is_complete(page_collection):
+                return None
+            if router.document_count() <= self.routing_top_documents:
+                return None
+            return router
+        except Exception as e:
+            print(f"Document routing unavailable: {e}")
+            return None
+
+    def get_routed_filters(self, router, query_embeddings):
+        if router is None:
+            return [None] * len(query_embeddings)
+        # Stage 1: pick the closest documents, stage 2 only searches their pages
+        routed_documents = router.route_batch(query_embeddings, self.routing_top_documents)
+        return [file_name_filter(file_names) if file_names else None for file_names in routed_documents]
+
+    def get_routed_filter(self, router, query_embedding):
+        if query_embedding is None:
+            return None
+        return self.get_routed_filters(router, [query_embedding])[0]
+
+    def get_search_filter(self, query_embedding=None):
+        if self.selected_document:
+            return {'file_name': {'$eq': self.selected_document}}
+        return self.get_routed_filter(self.router, query_embedding)
+
+    def get_search_filters(self, query_embeddings):
+        if self.selected_document:
+            return [{'file_name': {'$eq': self.selected_document}}] * len(query_embeddings)
+        return self.get_routed_filters(self.router, query_embeddings)
+
     def get_base_retriever(self):
         search_kwargs = {'k': 5}
-        if self.selected_document:
-            search_kwargs['filter'] = {'file_name': {'$eq': self.selected_document}}
+        search_filter = self.get_search_filter()
+        if search_filter:
+            search_kwargs['filter'] = search_filter
         #st.write(search_kwargs)
         base_retriever = self.vector_store.as_retriever(search_kwargs=search_kwargs)
         return base_retriever
 
-    def get_contextual_retriever(self):
+    def get_pipeline_compressor(self, embeddings=None):
         # Initialize embeddings (assuming embeddings is already defined elsewhere)
-        embeddings = self.embedding
+        embeddings = embeddings or self.embedding
 
         # Initialize Text Splitter
         splitter = CharacterTextSplitter(chunk_size=300, chunk_overlap=30, separator=". ")
@@ -228,19 +351,180 @@ class DatabaseTool:
         pipeline_compressor = DocumentCompressorPipeline(
             transformers=[splitter, redundant_filter, relevant_filter]
         )
-        
+
+        return pipeline_compressor
+
+    def get_contextual_retriever(self):
         # Initialize Contextual Compression Retriever
         contextual_retriever = ContextualCompressionRetriever(
-            base_compressor=pipeline_compressor, 
+            base_compressor=self.get_pipeline_compressor(), 
             base_retriever=self.get_base_retriever()
         )
         
         return contextual_retriever
 
-    def run(self, query: str):
-        contextual_retriever = self.get_contextual_retriever()
+    @staticmethod
+    def search_batch(vector_store, query_embeddings, search_filters, k=5):
+        """
+        Search a Chroma store for many query embeddings at once. Queries sharing a filter go
+        out in a single collection query. Returns a list of (Document, distance) per query.
+        """
+        results = [[] for _ in query_embeddings]
+
+        groups = {}
+        for i, search_filter in enumerate(search_filters):
+            groups.setdefault(json.dumps(search_filter, sort_keys=True), []).append(i)
+
+        for indexes in groups.values():
+            batch = vector_store._collection.query(
+                query_embeddings=[query_embeddings[i] for i in indexes],
+                n_results=k,
+                where=search_filters[indexes[0]],
+                include=["documents", "metadatas", "distances"],
+            )
+            for position, i in enumerate(indexes):
+                results[i] = [
+                    (Document(page_content=text, metadata=metadata or {}), distance)
+                    for text, metadata, distance in zip(batch["documents"][position], batch["metadatas"][position], batch["distances"][position])
+                ]
+        return results
+
+    def batch_retrieve(self, queries: List[str], query_embeddings=None):
+        # One embedding request and (per distinct filter) one vector store query for all queries
+        if query_embeddings is None:
+            query_embeddings = self.embedding.embed_documents(queries)
+        search_filters = self.get_search_filters(query_embeddings)
+        results = self.search_batch(self.vector_store, query_embeddings, search_filters, k=5)
+        return query_embeddings, [[doc for doc, _ in query_results] for query_results in results]
+
+    def batch_compress(self, queries: List[str], query_embeddings, docs_per_query):
+        embeddings = QueryEmbeddingCache(self.embedding)
+        splitter, redundant_filter, relevant_filter = self.get_pipeline_compressor(embeddings).transformers
+
+        splits_per_query = [splitter.split_documents(docs) for docs in docs_per_query]
+
+        # Embed every distinct split of every query in one request
+        unique_texts = list(dict.fromkeys(split.page_content for splits in splits_per_query for split in splits))
+        text_embeddings = dict(zip(unique_texts, self.embedding.embed_documents(unique_texts))) if unique_texts else {}
+
+        compressed_per_query = []
+        for query, query_embedding, splits in zip(queries, query_embeddings, splits_per_query):
+            if not splits:
+                compressed_per_query.append([])
+                continue
+            embeddings.set_query_embedding(query, query_embedding)
+            stateful_splits = [
+                _DocumentWithState(page_content=split.page_content, metadata=split.metadata, state={"embedded_doc": text_embeddings[split.page_content]})
+                for split in splits
+            ]
+            unique_splits = redundant_filter.transform_documents(stateful_splits)
+            relevant_splits = relevant_filter.compress_documents(unique_splits, query)
+            compressed_per_query.append(set_query_similarity(list(relevant_splits), query_embedding))
+        return compressed_per_query
+
+    def batch_get_relevant_documents(self, queries: List[str], query_embeddings=None):
+        query_embeddings, docs_per_query = self.batch_retrieve(queries, query_embeddings)
+        compressed_per_query = self.batch_compress(queries, query_embeddings, docs_per_query)
+        return list(zip(docs_per_query, compressed_per_query))
+
+    def retrieve(self, query: str):
+        _, docs_per_query = self.batch_retrieve([query])
+        return docs_per_query[0]
+
+    def get_relevant_documents(self, query: str, query_embedding=None):
+        query_embeddings = [query_embedding] if query_embedding is not None else None
+        return self.batch_get_relevant_documents([query], query_embeddings)[0]
+
+    def get_compressed_documents(self, query: str):
+        _, compressed_docs = self.get_relevant_documents(query)
+        return compressed_docs
+
+    # Speculative retrieval
+
+    def retrieve_with_embedding(self, query: str):
+        query_embeddings, docs_per_query = self.batch_retrieve([query])
+        compressed_docs = self.batch_compress([query], query_embeddings, docs_per_query)[0]
+        return query_embeddings[0], docs_per_query[0], compressed_docs, time.perf_counter()
+
+    def prefetch(self, query: str, executor):
+        """Start retrieving for the raw user input while the agent is still planning."""
+        self.prefetched = {
+            "query": query,
+            "started_at": time.perf_counter(),
+            "future": submit_with_context(executor, self.retrieve_with_embedding, query),
+        }
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().replace("?", " ").split())
+
+    def take_prefetched(self, query: str, similarity_threshold: float = 0.9):
+        """
+        The prefetched (initial, compressed) documents if the agent asked for about the same query, else None,
+        and the embedding of the agent's query when it had to be computed, for the retrieval that replaces them.
+        """
+        prefetched, self.prefetched = self.prefetched, None
+        if prefetched is None:
+            return None, None
+
+        wait_start = time.perf_counter()
+        try:
+            prefetch_embedding, initial_retrieved, compressed_docs, finished_at = prefetched["future"].result()
+        except Exception as e:
+            print(f"Speculative retrieval failed: {e}")
+            return None, None
+
+        query_embedding = None
+        if self.normalize_query(query) == self.normalize_query(prefetched["query"]):
+            similarity = 1.0
+        else:
+            query_embedding = self.embedding.embed_query(query)
+            similarity = float(np.dot(prefetch_embedding, query_embedding))
+        used = similarity >= similarity_threshold
+
+        # The part of the retrieval that ran before the tool asked for it is what the turn saved
+        saved_seconds = max(min(finished_at, wait_start) - prefetched["started_at"], 0.0) if used else 0.0
+        st.session_state.speculative_stats = {
+            "used": used,
+            "similarity": similarity,
+            "saved_seconds": saved_seconds,
+        }
+        print(f"Speculative retrieval {'used' if used else 'discarded'} (similarity {similarity:.3f}), saved {saved_seconds:.2f}s")
+        return ((initial_retrieved, compressed_docs), None) if used else (None, query_embedding)
+
+    def discard_prefetched(self):
+        if self.prefetched is not None:
+            self.prefetched["future"].cancel()
+            self.prefetched = None
+            st.session_state.speculative_stats = {"used": False, "similarity": None, "saved_seconds": 0.0}
+            print("Speculative retrieval discarded: the agent did not search the documents")
+
+    def build_output(self, query: str, compressed_docs, callbacks=None):
+        if st.session_state.get('use_extractive_compressor', False):
+            extractive_compressor = ExtractiveCompressor(
+                token_budget=st.session_state.get('extractive_token_budget', 500)
+            )
+            return extractive_compressor.compress(compressed_docs, query)
+
+        elif st.session_state.use_retriever_model:
+            # The retriever model only returns its extraction to the agent, so it gets its own window
+            context = ContextPacker.for_model("gpt-3.5-turbo-instruct", output_token_limit=500).pack(compressed_docs)
+            return self.extract_with_retriever_model(context, query, callbacks=callbacks)
+        
+        else:
+            return get_context_packer().pack(compressed_docs)
+
+    def run(self, query: str, callbacks=None):
+        return self.run_with_confidence(query, callbacks=callbacks)[0]
+
+    def run_with_confidence(self, query: str, callbacks=None):
+        """Run the tool and also return the best query similarity among the compressed chunks."""
         #DEBUGGING & EVALUTING ANSWERS:
-        compressed_docs = contextual_retriever.get_relevant_documents(query)
+        prefetched, query_embedding = self.take_prefetched(query)
+        if prefetched is not None:
+            initial_retrieved, compressed_docs = prefetched
+        else:
+            initial_retrieved, compressed_docs = self.get_relevant_documents(query, query_embedding=query_embedding)
         compressed_docs_list = []
         for doc in compressed_docs:
             doc_info = {
@@ -251,250 +535,265 @@ class DatabaseTool:
             compressed_docs_list.append(doc_info)
         #st.write(compressed_docs_list)
         
-        base_retriever=self.get_base_retriever()
-        initial_retrieved = base_retriever.get_relevant_documents(query)
         st.session_state.doc_sources = initial_retrieved
+        check_deadline()
 
-        context = "\n\n".join([f'"{doc.page_content}"' for doc in compressed_docs])
-
-        if st.session_state.use_retriever_model:
-            prompt_template = f"""
-            You are a specialized retriever model. Given the context from the documents below, your task is to:
-            1. Extract in details all relevant pieces of information that answers the query.
-            2. Always prioritize numerical values, names, or specific details over vague and general content.
-            3. If there are no relevant information in the context to the query, explicitly state that. 
-
-            Context:
-            {context}
+        confidence = max((ContextPacker.score(doc) for doc in compressed_docs), default=0.0)
+        return self.build_output(query, compressed_docs, callbacks=callbacks), confidence
 
-            Query:
-            {query}
-            """
+    def batch_run(self, queries: List[str]):
+        """Batch version of run: returns one tool output per query, in order."""
+        if not queries:
+            return []
+        results = self.batch_get_relevant_documents(queries)
 
-            print(prompt_template)
-
-            try:
-                response = openai.Completion.create(
-                    engine="gpt-3.5-turbo-instruct",  
-                    prompt=prompt_template,
-                    max_tokens=500,  # Adjust as needed
-                temperature=0  # Adjust as needed
-                )
-                # Extract and Process the Response
-                output = response.choices[0].text.strip()
-                
-            except openai.error.OpenAIError as e:
-                # Handle the exception as per your requirements
-                st.error(f"Error: {e}")
-                output = None
-
-            print(output)
-            return output
-        
-        else:
-            return context
-    
+        if st.session_state.use_retriever_model and not st.session_state.get('use_extractive_compressor', False):
+            # The retriever model is one LLM call per query, so run them side by side
+            with ThreadPoolExecutor(max_workers=min(self.max_batch_workers, len(queries))) as executor:
+                futures = [
+                    submit_with_context(executor, self.build_output, query, compressed_docs)
+                    for query, (_, compressed_docs) in zip(queries, results)
+                ]
+                return [future.result() for future in futures]
 
-class BR18_DB:
-    def __init__(self, llm, folder_path: str):
-        self.llm = llm
-        self.folder_path = folder_path
-        self.md_paths = self.load_documents()  # Renamed from pdf_paths to md_paths
-        self.embeddings = OpenAIEmbeddings()
-        self.pinecone_index_name = "br18"     
-        self.id_key = "doc_id" 
+        return [self.build_output(query, compressed_docs) for query, (_, compressed_docs) in zip(queries, results)]
 
-        self.br18_parent_store = InMemoryStore()
-        current_directory = os.getcwd()
-        store_path = os.path.join(current_directory, "inmemorystore", "br18_parent_store.pkl")
+    def extract_with_retriever_model(self, context: str, query: str, callbacks=None):
+        prompt_template = f"""
+        You are a specialized retriever model. Given the context from the documents below, your task is to:
+        1. Extract in details all relevant pieces of information that answers the query.
+        2. Always prioritize numerical values, names, or specific details over vague and general content.
+        3. If there are no relevant information in the context to the query, explicitly state that. 
 
-        if self.pinecone_index_name not in pinecone.list_indexes():
-            pinecone.create_index(self.pinecone_index_name, dimension=1536)
-            self.vectorstore = self.create_vectorstore()
-            self.serialize_inmemorystore(store_path)
-        else:
-            self.vectorstore = Pinecone.from_existing_index(self.pinecone_index_name, self.embeddings)
-            with open(store_path, "rb") as f:
-                self.br18_parent_store = pickle.load(f)
+        Context:
+        {context}
 
-        self.retriever = None
-    
-    def serialize_inmemorystore(self, store_path):
-        with open(store_path, "wb") as f:
-            pickle.dump(self.br18_parent_store, f)
-
-    def load_documents(self):
-        md_paths = list(Path(self.folder_path).rglob("*.md"))
-        documents = []
-        for path in md_paths:
-            loader = TextLoader(str(path))
-            #st.write(loader)
-            data = loader.load()
-            documents.extend(data)  # Assuming data is a list of Document objects
-        #st.text(documents)
-        return documents
-    
-    def split_and_chunk_text(self, markdown_document: Document):
+        Query:
+        {query}
+        """
 
-        markdown_text = markdown_document.page_content
-        
-        # Define headers to split on
-        headers_to_split_on = [
-            ("#", "Header 1"),
-            ("##", "Header 2"),
-            ("###", "Header 3"),
-            ("####", "Header 4"),
-        ]
-        
-        markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
-        #st.write(markdown_splitter)
-        
-        md_header_splits = markdown_splitter.split_text(markdown_text)
-        #st.write(md_header_splits)
-        #st.write(type(md_header_splits[0]))
-        
-        parent_chunk_size = 5000
-        parent_chunk_overlap = 0
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=parent_chunk_size, chunk_overlap=parent_chunk_overlap
-        )
-        
-        # Split the header-split documents into chunks
-        all_parent_splits = text_splitter.split_documents(md_header_splits)
+        print(prompt_template)
 
-        for split in all_parent_splits:
-            header_3 = split.metadata.get('Header 3', '')
-            header_4 = split.metadata.get('Header 4', '')
+        try:
+            # Streamed, so the extraction shows up in the chat while it is generated
+            output = stream_completion(prompt_template, max_tokens=500, tool_name="Document_Database", callbacks=callbacks)
             
-            # Prepend "Section:" to Header 4 if it exists
-            if header_4:
-                header_4 = f"Section: {header_4}"
-
-            metadata_str = f"{header_3}\n\n{header_4}"
-            split.page_content = f"{metadata_str}\n\n{split.page_content}"
-            split.metadata['type'] = 'parents'
+        except openai.error.OpenAIError as e:
+            # Handle the exception as per your requirements
+            st.error(f"Error: {e}")
+            output = None
 
-        return all_parent_splits
+        print(output)
+        return output
     
-    def save_summaries(self, summaries: List[str]):
-        """Save the generated summaries to a JSON file."""
-        current_directory = os.getcwd()
-        save_path = os.path.join(current_directory, 'savesummary', 'br18_summaries.json')
-        with open(save_path, 'w') as f:
-            json.dump(summaries, f)
 
-    def load_summaries(self) -> List[str]:
-        """Load summaries from a JSON file if it exists."""
-        current_directory = os.getcwd()
-        load_path = os.path.join(current_directory, 'savesummary', 'br18_summaries.json')
-        if os.path.exists(load_path):
-            with open(load_path, 'r') as f:
-                summaries = json.load(f)
-            return summaries
-        else:
-            return None  # or raise an exception, or generate new summaries
+class FederatedDatabaseTool(DatabaseTool):
+    def __init__(self, llm, vector_stores: Dict, per_collection_k: int = 3, k: int = 5):
+        self.vector_stores = vector_stores
+        self.per_collection_k = per_collection_k
+        self.k = k
+        super().__init__(llm=llm, vector_store=None)
+
+    def load_document_router(self, vector_store):
+        # One router per collection, keyed by collection name
+        self.routers = {
+            collection_name: super(FederatedDatabaseTool, self).load_document_router(store)
+            for collection_name, store in self.vector_stores.items()
+        }
+        return None
 
-    def generate_summaries(self, parent_splits: List[Document]) -> List[str]:
-        loaded_summaries = self.load_summaries()
-        if loaded_summaries is not None:
-            return loaded_summaries
-        
-        chain = (
-            {"doc": lambda x: x.page_content}
-            | ChatPromptTemplate.from_template("Summarize the following document:\n\n{doc}")
-            | ChatOpenAI(max_retries=3)
-            | StrOutputParser()
-        )
-        summaries = chain.batch(parent_splits, {"max_concurrency": 4})
+    def get_description(self):
+        base_description = "Always useful for finding the exactly written answer to the question by looking into several collections of documents at once."
+        footer_description = "Input should be a query, not referencing any obscure pronouns from the conversation before that will pull out relevant information from the database. Use this more than the normal search tool"
+        collections_description = f"This tool is currently searching the collections {', '.join(self.vector_stores.keys())}"
+        return f"{base_description} {collections_description}. {footer_description}"
+
+    def search_collection(self, collection_name, query_embeddings):
+        vector_store = self.vector_stores[collection_name]
+        search_filters = self.get_routed_filters(self.routers.get(collection_name), query_embeddings)
+        results = self.search_batch(vector_store, query_embeddings, search_filters, k=self.per_collection_k)
+        for query_results in results:
+            for doc, _ in query_results:
+                doc.metadata['collection'] = collection_name
+        return results
+
+    def batch_retrieve(self, queries: List[str], query_embeddings=None):
+        # One shared set of query embeddings, scattered to every collection concurrently
+        if query_embeddings is None:
+            query_embeddings = self.embedding.embed_documents(queries)
+
+        gathered = [[] for _ in queries]
+        with ThreadPoolExecutor(max_workers=len(self.vector_stores)) as executor:
+            futures = {
+                executor.submit(self.search_collection, collection_name, query_embeddings): collection_name
+                for collection_name in self.vector_stores
+            }
+            for future in as_completed(futures):
+                try:
+                    for i, query_results in enumerate(future.result()):
+                        gathered[i].extend(query_results)
+                except Exception as e:
+                    print(f"Search in collection '{futures[future]}' failed: {e}")
 
-        self.save_summaries(summaries)
-        
-        return summaries
-    
-    def generate_child_splits(self, parent_splits: List[Document], summaries: List[str]) -> List[Document]:
-        child_chunk_size = 300
+        # Chroma returns distances, so lower is closer. Each collection already respects its quota.
+        docs_per_query = []
+        for query_results in gathered:
+            query_results.sort(key=lambda result: result[1])
+            docs_per_query.append([doc for doc, _ in query_results[:self.k]])
+        return query_embeddings, docs_per_query
 
-        child_text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=child_chunk_size, chunk_overlap=0
-        )
 
-        all_child_splits = []
-        for i, parent_split in enumerate(parent_splits):
-            child_splits = child_text_splitter.split_text(parent_split.page_content)
+@st.cache_resource(show_spinner="Loading BR18...")
+def get_br18_store(folder_path: str):
+    """Process-wide BR18 store, built on first use and shared by every session and agent."""
+    return BR18Store(folder_path)
 
-            new_metadata = dict(parent_split.metadata)
-            new_metadata['type'] = 'children'
 
-            summary_with_prefix = f"Summary: {summaries[i]}"
+class BR18Store:
+    # Process-wide loading metrics, shown in the agent settings
+    load_count = 0
+    load_seconds = None
+    loaded_at = None
+    max_rss_mb = None
 
-            first_child_content = f"{child_splits[0]}\n\n{summary_with_prefix}"
+    def __init__(self, folder_path: str):
+        start_time = time.perf_counter()
 
-            first_child_split = Document(
-            page_content=first_child_content,
-            metadata=new_metadata
-            )
+        self.folder_path = folder_path
+        self.embeddings = OpenAIEmbeddings()
+        self.pinecone_index_name = BR18_INDEX_NAME
+        self.id_key = BR18_ID_KEY
 
-            all_child_splits.append(first_child_split)  # Append only the first child split (assuming it contains the metadata)
+        current_directory = os.getcwd()
+        parent_store_path = os.path.join(current_directory, BR18_PARENT_STORE_PATH)
+        self.br18_parent_store = SQLiteDocStore(parent_store_path)
 
+        if self.pinecone_index_name not in pinecone.list_indexes():
+            # Building the index takes minutes, so it never runs inside a user's request
+            raise RuntimeError("The BR18 index has not been built yet. Run `python -m agent.br18_build` first.")
+
+        self.vectorstore = Pinecone.from_existing_index(self.pinecone_index_name, self.embeddings, text_key=BR18_TEXT_KEY)
+        if self.br18_parent_store.count() == 0:
+            # Parents built before the SQLite docstore were pickled; import them once
+            pickle_path = os.path.join(current_directory, "inmemorystore", "br18_parent_store.pkl")
+            imported_count = self.br18_parent_store.import_pickled_store(pickle_path)
+            print(f"Imported {imported_count} BR18 parents from {pickle_path}")
+
+        self.clause_index = ClauseIndex.load(parent_store_path)
+        if self.clause_index is None:
+            # Parents built before the clause index was stored with them; index them once
+            self.clause_index = ClauseIndex.from_docstore(self.br18_parent_store)
+            self.clause_index.save(parent_store_path)
+        print(f"Loaded {len(self.clause_index)} BR18 clauses")
+
+        BR18Store.load_count += 1
+        BR18Store.load_seconds = time.perf_counter() - start_time
+        BR18Store.loaded_at = datetime.now()
+        BR18Store.max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"BR18 store loaded in {BR18Store.load_seconds:.2f}s (load #{BR18Store.load_count} in this process, peak RSS {BR18Store.max_rss_mb:.0f} MB)")
 
-        return all_child_splits
 
-    def process_all_documents(self):
-        all_parent_splits = []  # Local variable to store all parent splits
-        all_child_splits = []  # Local variable to store all child splits
-        
-        for markdown_document in self.md_paths:
-            parent_splits = self.split_and_chunk_text(markdown_document)
-            all_parent_splits.extend(parent_splits)
+class BR18_DB:
+    # Number of agents built with BR18 in this process; each reuses the shared store
+    instance_count = 0
 
-        summaries = self.generate_summaries(all_parent_splits)
-        all_child_splits = self.generate_child_splits(all_parent_splits, summaries)
+    def __init__(self, llm, folder_path: str, store=None):
+        self.llm = llm
+        self.folder_path = folder_path
+        self.store = store if store is not None else get_br18_store(folder_path)
+        self.embeddings = self.store.embeddings
+        self.vectorstore = self.store.vectorstore
+        self.br18_parent_store = self.store.br18_parent_store
+        self.id_key = self.store.id_key
+        self.clause_index = self.store.clause_index
 
-        #st.write(all_parent_splits)
-        #st.write(all_child_splits)
+        self.retriever = None
+        BR18_DB.instance_count += 1
 
-        return all_parent_splits, all_child_splits  # Return both lists
-    
-    def create_vectorstore(self):
-        all_parent_splits, all_child_splits = self.process_all_documents()
-    
-        parent_doc_ids = [str(uuid.uuid4()) for _ in all_parent_splits]
-        self.br18_parent_store.mset(list(zip(parent_doc_ids, all_parent_splits)))
+    def search_parents(self, query_embedding: List[float], k: int) -> List[Document]:
+        """
+        Search the child vectors and return their parent splits. Each parent carries the stored
+        vector and score of its child, so the embedding filters do not embed it again.
+        """
+        child_docs = query_pinecone_with_values(self.vectorstore, query_embedding, k)
+
+        unique_children = []
+        seen_ids = set()
+        for child_doc in child_docs:
+            doc_id = child_doc.metadata.get(self.id_key)
+            if doc_id and doc_id not in seen_ids:
+                seen_ids.add(doc_id)
+                unique_children.append(child_doc)
+
+        parent_docs = self.br18_parent_store.mget([child_doc.metadata[self.id_key] for child_doc in unique_children])
+
+        stateful_parents = []
+        for child_doc, parent_doc in zip(unique_children, parent_docs):
+            if parent_doc is None:
+                continue
+            stateful_parents.append(
+                _DocumentWithState(
+                    page_content=parent_doc.page_content,
+                    metadata=dict(parent_doc.metadata),
+                    state=dict(child_doc.state),
+                )
+            )
+        return stateful_parents
+
+    def lookup_clauses(self, query: str) -> List[Document]:
+        """Parents the query refers to by clause number or section header, without any vector search."""
+        doc_ids = self.clause_index.lookup(query)
+        if not doc_ids:
+            return []
+        parent_docs = self.br18_parent_store.mget(doc_ids)
+        # Exact matches rank above any similarity score when the context is packed
+        return [
+            _DocumentWithState(page_content=doc.page_content, metadata=dict(doc.metadata), state={"query_similarity_score": 1.0})
+            for doc in parent_docs if doc is not None
+        ]
 
-        for parent_id, child_split in zip(parent_doc_ids, all_child_splits):
-            child_split.metadata[self.id_key] = parent_id
+    def create_retriever(self, query: str):
+        start_time = time.perf_counter()
+        retrieved_docs, vector_queries = self.retrieve(query)
+        latency_ms = (time.perf_counter() - start_time) * 1000
 
-        # Create and save the vector store to disk
-        br18_vectorstore = Pinecone.from_documents(documents=all_child_splits, embedding=self.embeddings, index_name=self.pinecone_index_name)
-        #st.write(br18_appendix_child_vectorstore)
+        print(f"BR18 retrieval: {vector_queries} vector query(ies) in {latency_ms:.0f} ms")
+        if vector_queries > 1:
+            print("Warning: BR18 retrieval made more than one Pinecone round trip")
+        return retrieved_docs
 
-        for i, doc in enumerate(all_parent_splits):
-            doc.metadata[self.id_key] = parent_doc_ids[i]
+    def retrieve(self, query: str, search_type: str = None, clause_lookup: bool = None):
+        """
+        Retrieve for one query and return the documents with the number of vector queries made.
+        The count is per call, since the planner retrieves for several sub-queries at once.
+        """
+        if search_type is None:
+            search_type = st.session_state.search_type
+        if clause_lookup is None:
+            clause_lookup = st.session_state.get('br18_clause_lookup', True)
 
-        # Store the vector store in the session state
-        st.session_state.br18_vectorstore = br18_vectorstore
+        vector_queries = 0
 
-        return br18_vectorstore
+        if clause_lookup:
+            exact_docs = self.lookup_clauses(query)
+            if exact_docs:
+                st.session_state.doc_sources = exact_docs
+                return exact_docs, vector_queries
 
-    def create_retriever(self, query: str):
-        search_type = st.session_state.search_type
+        # Embed the query once; every filter below reads it from the cache
+        embeddings = QueryEmbeddingCache(self.embeddings)
+        query_embedding = embeddings.embed_query(query)
 
         if search_type == "By Context":
-            # Initialize retriever for By Context, filtering by the presence of the "text" metadata
-            general_retriever = MultiVectorRetriever(
-                vectorstore=self.vectorstore,
-                docstore=self.br18_parent_store,
-                id_key=self.id_key,
-                search_kwargs={"k": 5}
-            )
-
-            parent_docs = general_retriever.vectorstore.similarity_search(query, k = 5)
-            #st.write(parent_docs)
+            # One vector query; the sources and the compressed context both come from its results
+            parent_docs = self.search_parents(query_embedding, k=5)
+            vector_queries += 1
 
             st.session_state.doc_sources = parent_docs
 
-            embeddings = self.embeddings
+            # Drop near-duplicate parents using the stored child vectors, before any splitting
+            stored_redundant_filter = EmbeddingsRedundantFilter(embeddings=embeddings)
+            candidate_parent_docs = stored_redundant_filter.transform_documents(parent_docs)
         
             # Initialize Redundant Filter
             redundant_filter = EmbeddingsRedundantFilter(embeddings=embeddings)
@@ -507,18 +806,15 @@ class BR18_DB:
             splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=50, separator=". ")
             
             # Create Compressor Pipeline
+            # The splits are new text with no stored vectors, so they are embedded once and shared by both filters
             pipeline_compressor = DocumentCompressorPipeline(
                 transformers=[splitter, redundant_filter, relevant_filter]
             )
-            
-            # Initialize Contextual Compression Retriever
-            contextual_general_retriever = ContextualCompressionRetriever(
-                base_compressor=pipeline_compressor, 
-                base_retriever=general_retriever
-        )
         
             # Retrieve parent documents that match the query
-            retrieved_parent_docs = contextual_general_retriever.get_relevant_documents(query)
+            retrieved_parent_docs = pipeline_compressor.compress_documents(candidate_parent_docs, query)
+            # Score the splits for the cascade and the context packer
+            set_query_similarity(retrieved_parent_docs, query_embedding)
             
             # Display retrieved parent documents
             display_list = []
@@ -532,30 +828,17 @@ class BR18_DB:
                 display_list.append(display_dict)
             #st.write(display_list)
             
-            return retrieved_parent_docs
+            return retrieved_parent_docs, vector_queries
         
         elif search_type == "By Headers":
-        # Initialize retriever for By Headers, filtering by the absence of the "text" metadata
-            specific_retriever = MultiVectorRetriever(
-                vectorstore=self.vectorstore,
-                docstore=self.br18_parent_store,
-                id_key=self.id_key,
-                search_kwargs={"k": 3}
-            )
-
-            child_docs = specific_retriever.vectorstore.similarity_search(query, k = 3)
-            #st.write(child_docs)
-
-            # Retrieve child documents that match the query
+            # Retrieve child documents that match the query, carrying their stored vectors
+            stateful_parent_docs = self.search_parents(query_embedding, k=3)
+            vector_queries += 1
             
-            embeddings = self.embeddings
             embedding_filter = EmbeddingsFilter(embeddings=embeddings, similarity_threshold=0.75)
             #llm_filter = LLMChainFilter.from_llm(self.llm)
 
-            
-            compression_retriever = ContextualCompressionRetriever(base_compressor=embedding_filter, base_retriever=specific_retriever)
-
-            retrieved_child_docs = compression_retriever.get_relevant_documents(query)
+            retrieved_child_docs = set_query_similarity(embedding_filter.compress_documents(stateful_parent_docs, query), query_embedding)
 
             st.session_state.doc_sources = retrieved_child_docs
 
@@ -571,9 +854,15 @@ class BR18_DB:
                 display_list.append(display_dict)
             #st.write(display_list)
             
-            return retrieved_child_docs
-        
+            return retrieved_child_docs, vector_queries
+
+        return [], vector_queries
+
     def run(self, query: str):
+        return self.run_with_confidence(query)[0]
+
+    def run_with_confidence(self, query: str):
+        """Run the tool and also return the best query similarity among the retrieved parents."""
         prompt_template = """The following pieces of context are from the BR18. Use them to answer the question at the end. 
         The answer should be as specific as possible and remember to mention requirement numbers and integer values where relevant
         Always reference to a chapter and section and their respective clauses and subclauses numbers 
@@ -594,23 +883,166 @@ class BR18_DB:
         )
 
         # Retrieve the filtered documents
-        retrieved_docs = self.create_retriever(query)
+        retrieved_docs = get_context_packer().pack_documents(self.create_retriever(query))
+        confidence = max((ContextPacker.score(doc) for doc in retrieved_docs), default=0.0)
         #st.write(type(filtered_docs[0]))
         #st.write(filtered_docs)
 
+        check_deadline()
         qa_chain = load_qa_chain(self.llm, chain_type="stuff", verbose=True, prompt=PROMPT)
         output = qa_chain({"input_documents": retrieved_docs, "question": query}, return_only_outputs=True)
 
 
-        return output
+        return output, confidence
     
 
+class SubQueryPlanner:
+    """
+    Splits a compound question into self-contained sub-queries, runs every retrieval for
+    every sub-query concurrently and returns one merged, deduplicated context.
+    """
+
+    def __init__(self, llm, retrievers: Dict, max_sub_queries: int = 4):
+        self.llm = llm
+        self.retrievers = retrievers  # Tool name -> callable returning a list of Documents
+        self.max_sub_queries = max_sub_queries
+
+    def decompose(self, query: str) -> List[str]:
+        prompt = ChatPromptTemplate.from_template(
+            """Split the question below into at most {max_sub_queries} short, self-contained search queries, one per line.
+            Each query must cover exactly one part of the question and repeat any subject it refers to.
+            If the question only asks one thing, return it unchanged on a single line. Do not number the lines.
+
+            Question: {question}"""
+        )
+        chain = prompt | self.llm | StrOutputParser()
+
+        try:
+            output = chain.invoke({"question": query, "max_sub_queries": self.max_sub_queries})
+        except Exception as e:
+            print(f"Query decomposition failed: {e}")
+            return [query]
+
+        sub_queries = []
+        for line in output.splitlines():
+            sub_query = line.strip().lstrip("-*0123456789.) ").strip()
+            if sub_query and sub_query not in sub_queries:
+                sub_queries.append(sub_query)
+        return sub_queries[:self.max_sub_queries] or [query]
+
+    @staticmethod
+    def is_duplicate(doc: Document, kept_docs: List[Document]) -> bool:
+        # Exact repeats and chunks fully contained in an already kept chunk
+        text = " ".join(doc.page_content.split())
+        return any(text in " ".join(kept.page_content.split()) for kept in kept_docs)
+
+    def run(self, query: str):
+        sub_queries = self.decompose(query)
+        print(f"Sub-queries: {sub_queries}")
+
+        tasks = [(sub_query, tool_name) for sub_query in sub_queries for tool_name in self.retrievers]
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = {
+                submit_with_context(executor, self.retrievers[tool_name], sub_query): (sub_query, tool_name)
+                for sub_query, tool_name in tasks
+            }
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Retrieval for {futures[future]} failed: {e}")
+                    results[futures[future]] = []
+
+        all_docs = []
+        docs_by_sub_query = []
+        for sub_query in sub_queries:
+            sub_query_docs = []
+            for tool_name in self.retrievers:
+                for doc in results.get((sub_query, tool_name), []):
+                    doc.metadata['source'] = doc.metadata.get('source', tool_name)
+                    sub_query_docs.append(doc)
+
+            # Longest chunks first, so shorter chunks they contain are dropped
+            new_docs = []
+            for doc in sorted(sub_query_docs, key=lambda doc: len(doc.page_content), reverse=True):
+                if not self.is_duplicate(doc, all_docs + new_docs):
+                    new_docs.append(doc)
+            all_docs.extend(new_docs)
+            docs_by_sub_query.append((sub_query, new_docs))
+
+        # Keep the merged context inside the agent's token budget
+        packed_ids = {id(doc) for doc in get_context_packer().pack_documents(all_docs)}
+
+        sections = []
+        for sub_query, sub_query_docs in docs_by_sub_query:
+            packed_docs = [doc for doc in sub_query_docs if id(doc) in packed_ids]
+            if packed_docs:
+                chunks = "\n\n".join([f'"{doc.page_content}"' for doc in packed_docs])
+                sections.append(f"Sub-query: {sub_query}\n\n{chunks}")
+
+        st.session_state.doc_sources = [doc for doc in all_docs if id(doc) in packed_ids]
+
+        if not sections:
+            return "No relevant information was found for any part of the question."
+        return "\n\n".join(sections)
+
+
+class ToolCascade:
+    """
+    Runs the search tools cheapest first and only moves on to the next one while the results so far
+    are not confident enough, so e.g. web scraping is skipped when the documents already answer.
+
+    Each step is (name, callable returning (output, confidence)); confidence is the best query
+    similarity of the step's retrieved chunks, or None for a last step that is not scored.
+    """
+
+    def __init__(self, steps: List[Tuple[str, object]], confidence_threshold: float = 0.82):
+        self.steps = steps
+        self.confidence_threshold = confidence_threshold
+
+    @staticmethod
+    def format_output(output) -> str:
+        # BR18 answers through a QA chain and returns its output dict
+        if isinstance(output, dict):
+            return output.get("output_text", "")
+        return output or ""
+
+    def run(self, query: str, callbacks=None):
+        outputs = []
+        doc_sources = []
+        stats = []
+        for index, (name, run_step) in enumerate(self.steps):
+            start_time = time.perf_counter()
+            check_deadline()
+            # A step that finds nothing may not set its sources; do not count the previous step's twice
+            st.session_state.doc_sources = []
+            output, confidence = run_step(query, callbacks)
+            stats.append({"tool": name, "confidence": confidence, "seconds": time.perf_counter() - start_time})
+            outputs.append(f"{name}:\n{self.format_output(output)}")
+            doc_sources.extend(st.session_state.get('doc_sources', []))
+
+            if confidence is not None and confidence >= self.confidence_threshold:
+                skipped = [step_name for step_name, _ in self.steps[index + 1:]]
+                if skipped:
+                    print(f"Cascade stopped at {name} (confidence {confidence:.3f}), skipped {', '.join(skipped)}")
+                break
+
+        st.session_state.doc_sources = doc_sources
+        st.session_state.cascade_stats = {
+            "steps": stats,
+            "skipped": [step_name for step_name, _ in self.steps[len(stats):]],
+        }
+        return "\n\n".join(outputs)
+
+
 class SummarizationTool:
     def __init__(self, document_chunks):
         self.llm = ChatOpenAI(
             temperature=0, 
             streaming=True,
-            model_name="gpt-3.5-turbo"
+            model_name="gpt-3.5-turbo",
+            cache=llm_cache_option()
         )
         self.document_chunks = document_chunks
         self.map_prompt_template, self.combine_prompt_template = self.load_prompts()
@@ -1,7 +1,10 @@
 import streamlit as st
 from agent.miracle import MRKL
+from agent.tools import BR18_DB, BR18Store
 from dotenv import load_dotenv
 from utility.sessionstate import Init
+from utility.llmcache import LLM_CACHE_ENABLED, get_llm_cache
+from agent.answer_cache import get_answer_cache
 
 
 def update_custom_db():
@@ -10,13 +13,47 @@ def update_custom_db():
 def update_use_retriever_model():
     st.session_state.use_retriever_model = not st.session_state.get('use_retriever_model', False)
 
+def update_use_extractive_compressor():
+    st.session_state.use_extractive_compressor = not st.session_state.get('use_extractive_compressor', False)
+
 def update_br18_exp():
     st.session_state.br18_exp = not st.session_state.get('br18_exp', False)
-    st.session_state.agent = MRKL()
+    st.session_state.agent = MRKL.load()
+
+def update_br18_clause_lookup():
+    st.session_state.br18_clause_lookup = not st.session_state.get('br18_clause_lookup', True)
 
 def update_web_search():
     st.session_state.web_search = not st.session_state.get('web_search', False)
-    st.session_state.agent = MRKL()
+    st.session_state.agent = MRKL.load()
+
+def update_query_planner():
+    st.session_state.query_planner = not st.session_state.get('query_planner', False)
+    st.session_state.agent = MRKL.load()
+
+def update_parallel_tools():
+    st.session_state.parallel_tools = not st.session_state.get('parallel_tools', False)
+    st.session_state.agent = MRKL.load()
+
+def update_llm_cache():
+    st.session_state.llm_cache = not st.session_state.get('llm_cache', False)
+    st.session_state.agent = MRKL.load()
+
+def update_answer_cache():
+    st.session_state.answer_cache = not st.session_state.get('answer_cache', False)
+
+def update_local_router():
+    st.session_state.local_router = not st.session_state.get('local_router', False)
+
+def update_speculative_retrieval():
+    st.session_state.speculative_retrieval = not st.session_state.get('speculative_retrieval', False)
+
+def update_cascade_mode():
+    st.session_state.cascade_mode = not st.session_state.get('cascade_mode', False)
+    st.session_state.agent = MRKL.load()
+
+def update_turn_deadline():
+    st.session_state.turn_deadline = not st.session_state.get('turn_deadline', False)
 
 def update_custom_llm_model():
     st.session_state.custom_llm_model = not st.session_state.get('custom_llm_model', False)
@@ -52,6 +89,131 @@ def main():
                 on_change=update_custom_llm_model,
                 )
 
+            st.checkbox(
+                label="Experimental Feature: Parallel Tool Calls", 
+                value=st.session_state.get('parallel_tools', False), 
+                help="Let the agent call several tools in one step and run them at the same time.",
+                key="parallel_tools_key", 
+                on_change=update_parallel_tools
+            )
+
+            st.checkbox(
+                label="Experimental Feature: Local Intent Router", 
+                value=st.session_state.get('local_router', False), 
+                help="Classify each message locally first. Small talk gets a direct reply and clear document questions go straight to retrieval, both without the agent's planning call.",
+                key="local_router_key", 
+                on_change=update_local_router
+            )
+
+            st.checkbox(
+                label="Experimental Feature: Speculative Retrieval", 
+                value=st.session_state.get('speculative_retrieval', False), 
+                help="Start searching the document database for the raw question while the agent plans. The result is used if the agent searches for about the same thing, and discarded otherwise.",
+                key="speculative_retrieval_key", 
+                on_change=update_speculative_retrieval
+            )
+
+            cascade_toggle = st.checkbox(
+                label="Experimental Feature: Tool Cascade", 
+                value=st.session_state.get('cascade_mode', False), 
+                help="Replace the document, BR18 and web search tools by one tool that searches them cheapest first, and only moves on while the retrieved text is not similar enough to the question.",
+                key="cascade_mode_key", 
+                on_change=update_cascade_mode
+            )
+
+            if cascade_toggle:
+                def update_cascade_threshold():
+                    st.session_state.cascade_threshold = st.session_state.cascade_threshold_key
+                    st.session_state.agent = MRKL.load()
+
+                st.slider(
+                    label="Cascade Confidence Threshold",
+                    min_value=0.7,
+                    max_value=0.95,
+                    value=st.session_state.get('cascade_threshold', 0.82),
+                    step=0.01,
+                    help="Stop at the first source whose best retrieved chunk is at least this similar to the question.",
+                    key="cascade_threshold_key",
+                    on_change=update_cascade_threshold
+                )
+
+            turn_deadline_toggle = st.checkbox(
+                label="Limit Response Time", 
+                value=st.session_state.get('turn_deadline', False), 
+                help="Give every answer a time budget. Tool calls that take too long are cancelled, and when the budget is spent the agent answers with what its tools found so far.",
+                key="turn_deadline_key", 
+                on_change=update_turn_deadline
+            )
+
+            if turn_deadline_toggle:
+                def update_turn_budget_seconds():
+                    st.session_state.turn_budget_seconds = st.session_state.turn_budget_seconds_key
+
+                def update_tool_timeout_seconds():
+                    st.session_state.tool_timeout_seconds = st.session_state.tool_timeout_seconds_key
+
+                st.slider(
+                    label="Time Budget per Answer (seconds)",
+                    min_value=10,
+                    max_value=180,
+                    value=st.session_state.get('turn_budget_seconds', 60),
+                    step=5,
+                    key="turn_budget_seconds_key",
+                    on_change=update_turn_budget_seconds
+                )
+                st.slider(
+                    label="Timeout per Tool Call (seconds)",
+                    min_value=5,
+                    max_value=120,
+                    value=st.session_state.get('tool_timeout_seconds', 30),
+                    step=5,
+                    key="tool_timeout_seconds_key",
+                    on_change=update_tool_timeout_seconds
+                )
+
+            llm_cache_toggle = st.checkbox(
+                label="Cache LLM Responses", 
+                value=st.session_state.get('llm_cache', False), 
+                help="Reuse stored answers to identical temperature-0 LLM requests, including evaluations and summaries. Entries expire after a week. Available when the server is started with LLM_CACHE=true.",
+                key="llm_cache_key", 
+                on_change=update_llm_cache,
+                disabled=not LLM_CACHE_ENABLED
+            )
+
+            if llm_cache_toggle and LLM_CACHE_ENABLED:
+                llm_cache = get_llm_cache()
+                st.caption(f"{llm_cache.count()} cached responses, {llm_cache.hits} hits and {llm_cache.misses} misses since the app started.")
+                if st.button("Clear LLM Cache", key="clear_llm_cache"):
+                    llm_cache.clear()
+                    st.success("LLM cache cleared!")
+
+            answer_cache_toggle = st.checkbox(
+                label="Experimental Feature: Semantic Answer Cache", 
+                value=st.session_state.get('answer_cache', False), 
+                help="Answer questions that are worded differently but mean the same as an earlier question on the same collection, document and settings with the stored answer. Only used for the first question of a conversation, and not while web search is enabled.",
+                key="answer_cache_key", 
+                on_change=update_answer_cache
+            )
+
+            if answer_cache_toggle:
+                def update_answer_cache_threshold():
+                    st.session_state.answer_cache_threshold = st.session_state.answer_cache_threshold_key
+
+                st.slider(
+                    label="Answer Cache Similarity Threshold",
+                    min_value=0.85,
+                    max_value=1.0,
+                    value=st.session_state.get('answer_cache_threshold', 0.95),
+                    step=0.01,
+                    key="answer_cache_threshold_key",
+                    on_change=update_answer_cache_threshold
+                )
+                answer_cache = get_answer_cache()
+                st.caption(f"{answer_cache.count()} cached answers, {answer_cache.hits} hits and {answer_cache.misses} misses since the app started.")
+                if st.button("Clear Answer Cache", key="clear_answer_cache"):
+                    answer_cache.clear()
+                    st.success("Answer cache cleared!")
+
             st.subheader("Tool Settings")
 
             custom_db = st.checkbox(
@@ -78,6 +240,14 @@ def main():
                 )
                 st.session_state.search_type = search_type
 
+            st.checkbox(
+                label="Experimental Feature: Multi-Part Question Planner", 
+                value=st.session_state.get('query_planner', False), 
+                help="Split compound questions into sub-queries and search the databases for all of them at once.",
+                key="query_planner_key", 
+                on_change=update_query_planner
+            )
+
             web_search_toggle = st.checkbox(
                 label="Experimental Feature: Web Search", 
                 value=st.session_state.get('web_search', False), 
@@ -147,6 +317,17 @@ def main():
                         on_change=update_memory_token_limit
                     )
 
+                    def update_tiered_memory():
+                        st.session_state.tiered_memory = not st.session_state.get('tiered_memory', False)
+
+                    st.checkbox(
+                        label="Summarize Older Turns",
+                        value=st.session_state.get('tiered_memory', False),
+                        help="Keep the recent turns within the memory token limit word for word, and fold older turns into a running summary and a short list of key facts instead of dropping them.",
+                        key="tiered_memory_key",
+                        on_change=update_tiered_memory
+                    )
+
                     def update_ouput_token_limit():
                         st.session_state.ouput_token_limit = st.session_state.ouput_token_limit_key
                     
@@ -163,7 +344,7 @@ def main():
                     st.info("Always remember to press 'Save' to activate new settings")
                     if st.button("Save", key="LLM Model"):
                         st.session_state.llm_model = selected_model
-                        st.session_state.agent = MRKL()  # Reinitialize the MRKL class
+                        st.session_state.agent = MRKL.load()  # Rebuild the parts of the agent the new settings affect
                         st.success("LLM model settings saved and agent reinitialized!")
 
             if custom_db:
@@ -187,14 +368,59 @@ def main():
                         
                         st.text_area("Prompt for Retriever Model", value=prompt_template, height=200, max_chars=None, key=None, help=None, disabled=True)
 
+                    use_extractive_compressor = st.checkbox(
+                        "Use Local Extractive Compressor",
+                        value=st.session_state.get('use_extractive_compressor', False),
+                        help="Keep the sentences that best match the query, scored locally instead of by the Retriever Model. Takes priority over the Retriever Model.",
+                        key="use_extractive_compressor_key",
+                        on_change=update_use_extractive_compressor,
+                    )
+
+                    if use_extractive_compressor:
+                        st.session_state.extractive_token_budget = st.slider(
+                            "Extractive Token Budget",
+                            min_value=100,
+                            max_value=1500,
+                            value=st.session_state.get('extractive_token_budget', 500),
+                            step=100,
+                        )
+
+                    document_routing = st.checkbox(
+                        "Use Document Routing",
+                        value=st.session_state.get('document_routing', True),
+                        help="Pick the closest documents first, then only search their pages. Used for large collections.",
+                        key="document_routing_key",
+                    )
+                    st.session_state.document_routing = document_routing
+
+                    if document_routing:
+                        st.session_state.routing_top_documents = st.slider(
+                            "Number of Routed Documents",
+                            min_value=1,
+                            max_value=10,
+                            value=st.session_state.get('routing_top_documents', 3),
+                        )
+
                     if st.button("Save", key="Document Database"):
-                        st.session_state.agent = MRKL()  # Reinitialize the MRKL class
+                        st.session_state.agent = MRKL.load()  # Rebuild the parts of the agent the new settings affect
                         st.success("Settings saved and agent reinitialized!")
 
             if br18_experiment:
                 with st.expander("BR18 Experiment Settings", expanded=True):
                     st.info("This feature is currently under development and not yet available.")
 
+                    st.checkbox(
+                        label="Exact Clause Lookup",
+                        value=st.session_state.get('br18_clause_lookup', True),
+                        help="Answer queries that name a clause (e.g. § 57, stk. 1) or a section directly from the clause index, using vector search only when nothing matches.",
+                        key="br18_clause_lookup_key",
+                        on_change=update_br18_clause_lookup,
+                    )
+
+                    if BR18Store.load_count:
+                        st.write(f"BR18 store loaded {BR18Store.load_count} time(s) in this process, taking {BR18Store.load_seconds:.2f}s at {BR18Store.loaded_at:%H:%M:%S} (peak RSS {BR18Store.max_rss_mb:.0f} MB).")
+                        st.write(f"Agents built with BR18 since then: {BR18_DB.instance_count}. They all share the same store.")
+
             if web_search_toggle:
                 with st.expander("Web Search Settings", expanded=True):
                     st.info("This feature is currently under development and not yet available.")
@@ -217,7 +443,7 @@ def main():
             st.session_state.system_message_content = system_message_content
             st.session_state.reflection_message_content = reflection_message_content
             st.session_state.formatting_message_content = formatting_message_content
-            st.session_state.agent = MRKL()
+            st.session_state.agent = MRKL.load()
             st.success("Settings saved and agent reinitialized!")
 
 
@@ -43,7 +43,7 @@ def update_focused_mode():
     if not st.session_state.focused_mode:
         st.session_state.pdf_display = False
         st.session_state.selected_document = None
-        st.session_state.agent = MRKL()
+        st.session_state.agent = MRKL.load()
 
 def update_pdf_display():
     st.session_state.pdf_display = not st.session_state.get('pdf_display', False)
@@ -70,6 +70,9 @@ def main():
                 st.warning("No collections available.")
             else:
                 actual_collection_name, collection_object = Main.handle_collection_selection(existing_collections)
+
+                with st.expander("Federated Search", expanded=bool(st.session_state.get('federated_collections'))):
+                    Main.handle_federated_selection(existing_collections)
             
                 focused_mode = st.checkbox(
                     "Enable Focused Mode",
@@ -111,7 +114,7 @@ def main():
                                 st.session_state.s3_object_url = None
 
                             else:
-                                st.session_state.agent = MRKL()
+                                st.session_state.agent = MRKL.load()
                                 document_data = collection_object.get(where={"file_name": {"$eq": selected_document}}, include=["documents", "metadatas"])
                                 
                                 #st.write(f"Debug: document_data['metadatas'] = {document_data['metadatas']}")
@@ -185,9 +188,45 @@ def main():
                 st.experimental_rerun()
 
 
-        #with st.expander("Cost Tracking", expanded=True):
-            #total_token = st.session_state.token_count
-            #st.write(total_token)
+        token_count = st.session_state.token_count
+        if token_count:
+            with st.expander("Cost Tracking"):
+                st.write(f"Tokens: {token_count.total_tokens} ({token_count.prompt_tokens} prompt, {token_count.completion_tokens} completion)")
+                st.write(f"Cost: ${token_count.total_cost:.4f}")
+
+                speculative_stats = st.session_state.speculative_stats
+                if speculative_stats:
+                    if speculative_stats['used']:
+                        st.write(f"Speculative retrieval was used and saved {speculative_stats['saved_seconds']:.2f}s.")
+                    else:
+                        st.write("Speculative retrieval was discarded.")
+
+                cascade_stats = st.session_state.get('cascade_stats', {})
+                if cascade_stats:
+                    steps = ", ".join(
+                        f"{step['tool']} ({step['confidence']:.2f})" if step['confidence'] is not None else step['tool']
+                        for step in cascade_stats['steps']
+                    )
+                    st.write(f"Tool cascade searched: {steps}")
+                    if cascade_stats['skipped']:
+                        st.write(f"Skipped: {', '.join(cascade_stats['skipped'])}")
+
+                deadline_stats = st.session_state.get('deadline_stats', {})
+                if deadline_stats:
+                    if deadline_stats['budget_seconds']:
+                        st.write(f"Answered in {deadline_stats['turn_seconds']:.1f}s of a {deadline_stats['budget_seconds']}s budget.")
+                    if deadline_stats['budget_exceeded']:
+                        st.write("The time budget ran out, so this is a best-effort answer from the tool results so far.")
+                    if deadline_stats['timed_out_tools']:
+                        st.write(f"Timed out and cancelled: {', '.join(deadline_stats['timed_out_tools'])}")
+                    if deadline_stats['total_tool_timeouts'] or deadline_stats['total_budget_overruns']:
+                        st.write(f"This session: {deadline_stats['total_tool_timeouts']} tool timeouts, {deadline_stats['total_budget_overruns']} budget overruns")
+
+                tool_memo_stats = st.session_state.tool_memo_stats
+                if tool_memo_stats.get('turn_calls'):
+                    st.write(f"Repeated tool calls served from this turn's results: {tool_memo_stats['turn_hits']}/{tool_memo_stats['turn_calls']} ({tool_memo_stats['turn_hits'] / tool_memo_stats['turn_calls']:.0%})")
+                if tool_memo_stats.get('total_calls'):
+                    st.write(f"Since the agent was built: {tool_memo_stats['total_hits']}/{tool_memo_stats['total_calls']} ({tool_memo_stats['total_hits'] / tool_memo_stats['total_calls']:.0%})")
 
         st.divider()
         buttons_placeholder = st.container()
@@ -195,7 +234,16 @@ def main():
             #st.button("Regenerate Response", key="regenerate", on_click=st.session_state.agent.regenerate_response)
             st.button("Clear Chat", key="clear", on_click=reset_chat)
 
-            relevant_keys = ["Header ", "Header 3", "Header 4", "page_number", "source", "file_name", "title", "author", "snippet", "unique_id"]
+            if st.session_state.tool_latency:
+                with st.expander("Tool Latency"):
+                    for tool_name, latency in st.session_state.tool_latency.items():
+                        time_to_first_token = latency["time_to_first_token"]
+                        if time_to_first_token is None:
+                            st.write(f"{tool_name}: no tokens, {latency['total']:.2f}s total")
+                        else:
+                            st.write(f"{tool_name}: first token after {time_to_first_token:.2f}s, {latency['total']:.2f}s total")
+
+            relevant_keys = ["Header ", "Header 3", "Header 4", "collection", "page_number", "source", "file_name", "title", "author", "snippet", "unique_id"]
             if st.session_state.doc_sources:
                 content = []
                 for document in st.session_state.doc_sources:
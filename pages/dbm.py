@@ -5,6 +5,8 @@ from UI.sidebar import Sidebar
 from utility.s3 import S3
 from utility.sessionstate import Init
 from UI.main import Main
+from agent.retrieval import DocumentRouter
+from agent.answer_cache import invalidate_cached_answers
 
 
 def get_user_collection_name(full_name):
@@ -103,6 +105,11 @@ def main():
 
                                 st.write("Deleting the following IDs: ", filtered_ids)  # Displaying IDs being deleted
                                 selected_collection_object.delete(ids=filtered_ids)
+
+                                router = DocumentRouter.load(st.session_state.client_db.client, selected_collection_name)
+                                if router is not None:
+                                    router.remove_document(parent_doc)
+                                invalidate_cached_answers(selected_collection_name)
                                 st.session_state['deleted'] = True
                     
                                 # Reset 'delete' state to False
@@ -160,6 +167,11 @@ def main():
 
                                 if st.button("Yes, Delete"):
                                     selected_collection_object.delete(selected_chunk_id)
+
+                                    router = DocumentRouter.load(st.session_state.client_db.client, selected_collection_name)
+                                    if router is not None:
+                                        router.refresh_document(selected_collection_object, parent_doc)
+                                    invalidate_cached_answers(selected_collection_name)
                                     st.session_state['deleted_chunk'] = True
                                     
                                     # Reset 'delete_chunk' state to False
@@ -192,6 +204,17 @@ def main():
             with st.expander("Rename a Collection"):
                 Main.rename_collection(existing_collections)
 
+            with st.expander("Document Routing Index"):
+                st.write("Rebuild the document-level routing index of the selected collection from its stored page embeddings. Only needed for documents ingested before routing was available.")
+                if selected_collection_object and st.button("Rebuild Routing Index"):
+                    try:
+                        with st.spinner("Rebuilding"):
+                            router = DocumentRouter(st.session_state.client_db.client, selected_collection_name)
+                            routed_document_count = router.rebuild(selected_collection_object)
+                        st.success(f"Routing index rebuilt for {routed_document_count} documents.")
+                    except ValueError as e:
+                        st.error(f"Cannot build the routing index: {e}")
+
 
 
 if __name__ == "__main__":
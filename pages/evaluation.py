@@ -24,6 +24,10 @@ from langchain.prompts import ChatPromptTemplate
 from langchain.schema.output_parser import StrOutputParser 
 import ast
 from utility.ingestion import PDFTextExtractor
+from agent.compressors import ExtractiveCompressor
+from utility.llmcache import llm_cache_option
+import numpy as np
+import time
 
 
 LOG_FILE = "./evaluation/evaluation_logs.csv"
@@ -124,7 +128,7 @@ def populate_dataset_with_context_and_answer(df, num_rows=None):
     # Slice the dataframe to only take the desired number of rows
     df = df.iloc[:num_rows]
 
-    llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo", verbose=True)
+    llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo", verbose=True, cache=llm_cache_option())
 
     template = """
         {system_message_content}
@@ -153,12 +157,13 @@ def populate_dataset_with_context_and_answer(df, num_rows=None):
     # Loop through each row in the DataFrame
     for batch in df_batches:
         prompts_data = []
+
+        # Retrieve the context of the whole batch at once
+        questions = batch['question'].tolist()
+        retrieved_contexts = db_tool_instance.batch_run(questions)
         
         # Prepare the input data for each question in the batch
-        for _, row in batch.iterrows():
-            question = row['question']
-            retrieved_context = db_tool_instance.run(question)
-
+        for question, retrieved_context in zip(questions, retrieved_contexts):
             prompts_data.append({
                 "system_message_content": st.session_state.system_message_content,
                 "formatting_message_content": st.session_state.formatting_message_content,
@@ -180,6 +185,61 @@ def populate_dataset_with_context_and_answer(df, num_rows=None):
     
     return df
 
+def compare_compressors(df, num_rows):
+    """Compare the retriever model (LLM) with the local extractive compressor on the same retrieved context."""
+    num_rows = min(num_rows, len(df))
+    df = df.iloc[:num_rows]
+
+    db_tool_instance = DatabaseTool(
+        llm=None,
+        vector_store=st.session_state.vector_store,
+    )
+    extractive_compressor = ExtractiveCompressor(token_budget=st.session_state.get('extractive_token_budget', 500))
+    embeddings = db_tool_instance.embedding
+
+    questions = df['question'].tolist()
+    query_embeddings = embeddings.embed_documents(questions)
+    relevant_documents = db_tool_instance.batch_get_relevant_documents(questions, query_embeddings)
+
+    rows = []
+    for (_, row), query_embedding, (_, compressed_docs) in zip(df.iterrows(), query_embeddings, relevant_documents):
+        question = row['question']
+        ground_truth = " ".join(row['ground_truths']) if 'ground_truths' in row else ""
+
+        context = "\n\n".join([f'"{doc.page_content}"' for doc in compressed_docs])
+
+        start_time = time.perf_counter()
+        llm_output = db_tool_instance.extract_with_retriever_model(context, question) or ""
+        llm_latency = (time.perf_counter() - start_time) * 1000
+
+        start_time = time.perf_counter()
+        extractive_output = extractive_compressor.compress(compressed_docs, question, query_embedding)
+        extractive_latency = (time.perf_counter() - start_time) * 1000
+
+        comparison = {
+            "question": question,
+            "llm_latency_ms": round(llm_latency, 1),
+            "extractive_latency_ms": round(extractive_latency, 1),
+            "llm_tokens": len(extractive_compressor.encoding.encode(llm_output)),
+            "extractive_tokens": len(extractive_compressor.encoding.encode(extractive_output)),
+        }
+
+        if ground_truth:
+            # Semantic similarity and term recall against the ground truth answer
+            truth_vector, llm_vector, extractive_vector = np.array(embeddings.embed_documents([ground_truth, llm_output or " ", extractive_output]))
+            comparison["llm_similarity"] = round(float(np.dot(truth_vector, llm_vector)), 3)
+            comparison["extractive_similarity"] = round(float(np.dot(truth_vector, extractive_vector)), 3)
+
+            truth_terms = set(ExtractiveCompressor.tokenize(ground_truth))
+            comparison["llm_term_recall"] = round(ExtractiveCompressor.lexical_overlap(truth_terms, set(ExtractiveCompressor.tokenize(llm_output))), 3)
+            comparison["extractive_term_recall"] = round(ExtractiveCompressor.lexical_overlap(truth_terms, set(ExtractiveCompressor.tokenize(extractive_output))), 3)
+
+        comparison["llm_output"] = llm_output
+        comparison["extractive_output"] = extractive_output
+        rows.append(comparison)
+
+    return pd.DataFrame(rows)
+
 def batchify(data, batch_size):
     """Utility function to split data into batches"""
     return [data[i : i + batch_size] for i in range(0, len(data), batch_size)]
@@ -234,7 +294,7 @@ def main():
         run_evaluation_button = st.button("Run Evaluation")
 
 
-    evaluation_tab, test_generator_tab = st.tabs(["Evaluation", "Test Data Generation"])
+    evaluation_tab, test_generator_tab, compressor_tab = st.tabs(["Evaluation", "Test Data Generation", "Compressor Comparison"])
 
     with evaluation_tab:
 
@@ -401,6 +461,24 @@ def main():
                 
 
 
+    with compressor_tab:
+        st.header("Retriever Model vs Local Extractive Compressor")
+        st.write("Runs the same retrieval for each question of the evaluation range, then compresses the context with both the Retriever Model and the local extractive compressor.")
+
+        if st.button("Run Comparison", key="run_compressor_comparison"):
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            with st.spinner("Comparing"):
+                comparison_df = compare_compressors(prepare_dataset(), st.session_state.evaluation_quantity)
+            st.session_state.df_compressor_display = comparison_df
+            save_eval_dataframe(comparison_df, f"{evaluation_name} - compressor - {timestamp}.csv", "compressor", timestamp, update_log=False)
+
+        if st.session_state.get('df_compressor_display') is not None:
+            comparison_df = st.session_state.df_compressor_display
+            st.subheader("Average")
+            st.dataframe(comparison_df.mean(numeric_only=True).round(3).to_frame("Value"))
+            st.subheader("Detailed")
+            st.dataframe(comparison_df, hide_index=True)
+
     st.write(st.session_state.vector_store)
     st.write(st.session_state.use_retriever_model)
     st.write(st.session_state.evaluation_quantity)
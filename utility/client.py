@@ -4,6 +4,7 @@ from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores import Chroma
 import streamlit as st
 from utility.authy import Login
+from agent.retrieval import is_routing_collection
 
 
 class ClientDB:
@@ -46,15 +47,22 @@ class ClientDB:
         st.session_state.vector_store = self.vector_store
         #st.write(st.session_state.vector_store)
 
+    def load_vector_stores(self, collection_names):
+        embeddings = OpenAIEmbeddings()
+        return {
+            collection_name: Chroma(collection_name=collection_name, embedding_function=embeddings, client=self.client)
+            for collection_name in collection_names
+        }
+
     def get_existing_collections(self):
         collections = self.client.list_collections()
-        sorted_collection = sorted([col.name for col in collections])
+        sorted_collection = sorted([col.name for col in collections if not is_routing_collection(col)])
         return sorted_collection
 
     def get_all_sorted_collections(self):
         all_collections_objects = self.client.list_collections()
         sorted_collections_objects = sorted(
-            all_collections_objects, 
+            [collection for collection in all_collections_objects if not is_routing_collection(collection)], 
             key=lambda collection: collection.name.lower()
         )
         return sorted_collections_objects
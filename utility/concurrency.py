@@ -0,0 +1,89 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised by work that finds its deadline has passed or that it was cancelled."""
+
+
+class Deadline:
+    """
+    A point in time by which some work should be done, and a flag to cancel it sooner.
+
+    Python threads cannot be stopped from outside, so long running work checks its deadline
+    between steps (check_deadline) and gives up once it has expired. A child deadline also
+    expires with its parent, so cancelling a turn cancels the tool calls made in it.
+    """
+
+    def __init__(self, seconds: Optional[float] = None, parent: Optional["Deadline"] = None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.parent = parent
+        self.cancel_event = threading.Event()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, or None when there is no limit."""
+        remaining = None if self.expires_at is None else self.expires_at - time.monotonic()
+        if self.parent is not None:
+            parent_remaining = self.parent.remaining()
+            if parent_remaining is not None:
+                remaining = parent_remaining if remaining is None else min(remaining, parent_remaining)
+        return remaining
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set() or (self.parent is not None and self.parent.is_cancelled())
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return self.is_cancelled() or (remaining is not None and remaining <= 0)
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("Deadline exceeded")
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def check_deadline():
+    """Raise DeadlineExceeded if the work running in this thread has run out of time."""
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]):
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """
+    Submit fn to a thread pool with the current Streamlit script context attached,
+    so the worker can still read st.session_state. fn also runs in a copy of the
+    caller's context variables, so it sees the current deadline and the callback
+    handlers LangChain keeps there (e.g. get_openai_callback's token counting).
+    """
+    ctx = get_script_run_ctx()
+    context = contextvars.copy_context()
+
+    def run_with_context():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return context.run(fn, *args, **kwargs)
+
+    return executor.submit(run_with_context)
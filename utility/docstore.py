@@ -0,0 +1,90 @@
+import os
+import json
+import pickle
+import sqlite3
+from typing import Iterator, List, Optional, Sequence, Tuple
+from langchain.schema import Document
+from langchain.schema.storage import BaseStore
+from utility.sqlite import ThreadLocalConnection
+
+
+class SQLiteDocStore(BaseStore[str, Document]):
+    """
+    On-disk key-value docstore for parent documents, backed by SQLite.
+
+    Nothing is loaded up front: mget reads only the requested keys. The file is memory-mapped
+    and opened in WAL mode, so several processes can read it at the same time. Each thread
+    gets its own connection because SQLite connections cannot be shared between threads.
+    """
+
+    def __init__(self, path: str, mmap_size: int = 256 * 1024 * 1024):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._connections = ThreadLocalConnection(path, [
+            f"PRAGMA mmap_size={mmap_size}",
+            "CREATE TABLE IF NOT EXISTS docs (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        ])
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    @staticmethod
+    def serialize(doc: Document) -> str:
+        return json.dumps({"page_content": doc.page_content, "metadata": doc.metadata})
+
+    @staticmethod
+    def deserialize(value: str) -> Document:
+        data = json.loads(value)
+        return Document(page_content=data["page_content"], metadata=data["metadata"])
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        if not keys:
+            return []
+        placeholders = ",".join("?" for _ in keys)
+        rows = self._connection().execute(f"SELECT key, value FROM docs WHERE key IN ({placeholders})", list(keys)).fetchall()
+        found = {key: self.deserialize(value) for key, value in rows}
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO docs (key, value) VALUES (?, ?)",
+                [(key, self.serialize(doc)) for key, doc in key_value_pairs],
+            )
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        connection = self._connection()
+        with connection:
+            connection.executemany("DELETE FROM docs WHERE key = ?", [(key,) for key in keys])
+
+    def replace(self, key_value_pairs: Sequence[Tuple[str, Document]], delete_keys: Sequence[str]) -> None:
+        """Write and delete in one transaction, so readers see either the old or the new set of documents."""
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO docs (key, value) VALUES (?, ?)",
+                [(key, self.serialize(doc)) for key, doc in key_value_pairs],
+            )
+            connection.executemany("DELETE FROM docs WHERE key = ?", [(key,) for key in delete_keys])
+
+    def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        if prefix:
+            rows = self._connection().execute("SELECT key FROM docs WHERE key LIKE ?", (f"{prefix}%",))
+        else:
+            rows = self._connection().execute("SELECT key FROM docs")
+        for (key,) in rows:
+            yield key
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def import_pickled_store(self, pickle_path: str) -> int:
+        """One-off migration from the pickled InMemoryStore used before this docstore existed."""
+        if not os.path.exists(pickle_path):
+            return 0
+        with open(pickle_path, "rb") as f:
+            in_memory_store = pickle.load(f)
+        key_value_pairs = list(in_memory_store.store.items())
+        self.mset(key_value_pairs)
+        return len(key_value_pairs)
@@ -13,6 +13,9 @@ from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import LLMChain
 import time
+from agent.retrieval import DocumentRouter
+from agent.answer_cache import invalidate_cached_answers
+from utility.llmcache import llm_cache_option
 
 
 
@@ -126,25 +129,36 @@ class DBStore:
         document_chunks = self.text_to_docs(cleaned_text_pdf)
         return document_chunks
 
-    def get_vectorstore(self, batch_size, delay):
+    def get_vectorstore(self, batch_size=50, delay=0):
         document_chunks = self.get_pdf_text()
 
         def split_list(input_list, chunk_size):
             for i in range(0, len(input_list), chunk_size):
                 yield input_list[i:i + chunk_size]
     
+        vectorstore = Chroma(
+            client=self.client,
+            collection_name=self.collection_name,
+            embedding_function=self.embeddings
+        )
+
+        # Ingesting a document again replaces its pages, so the routing index keeps covering every page
+        existing_ids = vectorstore.get(where={"file_name": {"$eq": self.file_name}}, include=[])["ids"]
+        if existing_ids:
+            vectorstore.delete(ids=existing_ids)
 
         for chunk in split_list(document_chunks, batch_size):
-            chunk_ids = [doc.metadata["unique_id"] for doc in chunk]
-            vectorstore = Chroma.from_documents(
-                documents=chunk,
-                embedding=self.embeddings,
-                ids=chunk_ids,
-                client=self.client,
-                collection_name=self.collection_name
-            )
+            vectorstore.add_documents(chunk, ids=[doc.metadata["unique_id"] for doc in chunk])
             time.sleep(delay)
 
+        # The centroid comes from the stored page vectors, so the pages are embedded only once
+        try:
+            router = DocumentRouter(self.client, self.collection_name)
+            router.refresh_document(vectorstore, self.file_name)
+        except ValueError as e:
+            print(f"Document routing unavailable: {e}")
+        invalidate_cached_answers(self.collection_name)
+
         return vectorstore
     
     def ingest_document(self, file, actual_collection_name):
@@ -196,7 +210,8 @@ class DBStore:
         llm = ChatOpenAI(
             temperature=0, 
             streaming=True,
-            model_name="gpt-3.5-turbo"
+            model_name="gpt-3.5-turbo",
+            cache=llm_cache_option()
             )
         document_filename = self.file_name
         document_title = self.metadata.get("title", None)
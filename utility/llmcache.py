@@ -0,0 +1,151 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import langchain
+import streamlit as st
+from typing import Optional
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema import Generation
+from langchain.schema.cache import BaseCache, RETURN_VAL_TYPE
+from utility.sqlite import ThreadLocalConnection
+
+
+LLM_CACHE_PATH = os.path.join("inmemorystore", "llm_cache.sqlite")
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+    Persistent exact-match cache of LLM responses, backed by SQLite.
+
+    Keyed on the model string LangChain builds from the model name and every generation parameter,
+    plus the full prompt (the serialized messages for chat models). Entries expire after ttl_seconds,
+    and the least recently used entries are evicted once there are more than max_entries.
+    Only deterministic (temperature 0) calls are cached.
+    """
+
+    # "0" or "0.0" and not the start of e.g. "0.7"
+    TEMPERATURE_ZERO = re.compile(r"""['"]temperature['"][,:]\s*0(?:\.0+)?(?![\d.])""")
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_seconds: int = 7 * 24 * 3600, max_entries: int = 5000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connections = ThreadLocalConnection(path, [
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, llm_string TEXT NOT NULL, response TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)",
+        ])
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    @staticmethod
+    def cache_key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, llm_string: str) -> bool:
+        return bool(self.TEMPERATURE_ZERO.search(llm_string))
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if not self.is_cacheable(llm_string):
+            return None
+
+        key = self.cache_key(prompt, llm_string)
+        connection = self._connection()
+        row = connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.ttl_seconds:
+            self.misses += 1
+            return None
+
+        with connection:
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        try:
+            return [loads(generation) for generation in json.loads(row[0])]
+        except Exception as e:
+            print(f"Could not load cached LLM response, ignoring it: {e}")
+            return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if not self.is_cacheable(llm_string):
+            return
+
+        now = time.time()
+        response = json.dumps([dumps(generation) for generation in return_val])
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, llm_string, response, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (self.cache_key(prompt, llm_string), llm_string, response, now, now),
+            )
+            self.evict(connection, now)
+
+    def evict(self, connection: sqlite3.Connection, now: float):
+        connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        excess = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if excess > 0:
+            connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (excess,),
+            )
+
+    def clear(self, **kwargs) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM responses")
+        self.hits = 0
+        self.misses = 0
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    # Raw openai.Completion calls, which do not go through LangChain
+
+    @staticmethod
+    def completion_llm_string(model_name: str, **params) -> str:
+        return json.dumps({"engine": model_name, **params}, sort_keys=True)
+
+    def lookup_completion(self, prompt: str, model_name: str, **params) -> Optional[str]:
+        generations = self.lookup(prompt, self.completion_llm_string(model_name, **params))
+        return generations[0].text if generations else None
+
+    def update_completion(self, prompt: str, text: str, model_name: str, **params):
+        self.update(prompt, self.completion_llm_string(model_name, **params), [Generation(text=text)])
+
+
+# Server setting: the cache is shared by every session in the process, so only the operator turns it on
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "false").strip().lower() in ("1", "true", "yes")
+
+
+@st.cache_resource
+def get_llm_cache() -> SQLiteLLMCache:
+    return SQLiteLLMCache()
+
+
+def configure_llm_cache():
+    """Install the cache for the LangChain models of this process once, when the server enables it."""
+    if LLM_CACHE_ENABLED and not isinstance(langchain.llm_cache, SQLiteLLMCache):
+        langchain.llm_cache = get_llm_cache()
+
+
+def llm_cache_option() -> Optional[bool]:
+    """
+    The cache= value for a model built for this session: None reads and writes the process cache,
+    False bypasses it. Sessions only use the cache after turning it on in the agent settings.
+    """
+    return None if LLM_CACHE_ENABLED and st.session_state.get('llm_cache', False) else False
+
+
+def active_llm_cache() -> Optional[SQLiteLLMCache]:
+    """The cache for raw completions made for this session, or None when the session does not use it."""
+    cache = langchain.llm_cache
+    if llm_cache_option() is False or not isinstance(cache, SQLiteLLMCache):
+        return None
+    return cache
@@ -1,6 +1,7 @@
 import streamlit as st
 from agent.miracle import MRKL
 from utility.client import ClientDB
+from utility.llmcache import configure_llm_cache
 import pinecone
 import os
 
@@ -10,9 +11,29 @@ class Init:
             # Common to agent.py and chat.py
             "llm_model": "gpt-3.5-turbo",
             "use_retriever_model": False,
+            "use_extractive_compressor": False,
+            "extractive_token_budget": 500,
+            "document_routing": True,
+            "routing_top_documents": 3,
             "vector_store": None,
             "br18_exp": False,
+            "br18_clause_lookup": True,
             "web_search": False,
+            "query_planner": False,
+            "parallel_tools": False,
+            "tiered_memory": False,
+            "llm_cache": False,
+            "answer_cache": False,
+            "answer_cache_threshold": 0.95,
+            "local_router": False,
+            "speculative_retrieval": False,
+            "speculative_stats": {},
+            "cascade_mode": False,
+            "cascade_threshold": 0.82,
+            "turn_deadline": False,
+            "turn_budget_seconds": 60,
+            "tool_timeout_seconds": 30,
+            "last_route": None,
             "system_message_content": """
             You are Miracle, an expert in construction, legal frameworks, and regulatory matters.
 
@@ -33,6 +54,9 @@ class Init:
                 Always self-reflect your answer based on the user's query and follows the list of response objective. 
                 """,  
             "selected_collection_state": None,
+            "federated_collections": [],
+            "federated_vector_stores": {},
+            "federated_quota": 3,
 
             # Specific to chat.py
             "messages": [{"roles": "assistant", "content": "Hi, I am Miracle. How can I help you?"}],
@@ -42,6 +66,10 @@ class Init:
             "br18_vectorstore": None,
             "history": None,
             "token_count": 0,
+            "tool_latency": {},
+            "tool_memo_stats": {},
+            "cascade_stats": {},
+            "deadline_stats": {},
             "focused_mode": False,
             "selected_document": None,
             "s3_object_url": None,
@@ -62,9 +90,11 @@ class Init:
             if key not in st.session_state:
                 st.session_state[key] = value
 
+        configure_llm_cache()
+
     def initialize_agent_state():
         if "agent" not in st.session_state:
-            st.session_state.agent = MRKL()
+            st.session_state.agent = MRKL.load()
 
     def initialize_clientdb_state():
         if st.session_state.username is None:
@@ -0,0 +1,27 @@
+import sqlite3
+import threading
+from typing import List
+
+
+class ThreadLocalConnection:
+    """
+    One connection per thread to the same SQLite file, since SQLite connections cannot be shared
+    between threads. Every connection is opened in WAL mode, so readers never block the writer,
+    and runs the setup statements (pragmas, tables, indexes) before it is first used.
+    """
+
+    def __init__(self, path: str, setup_statements: List[str]):
+        self.path = path
+        self.setup_statements = setup_statements
+        self._local = threading.local()
+        self.get()  # Create the file and tables up front
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.setup_statements:
+                connection.execute(statement)
+            self._local.connection = connection
+        return connection